@@ -0,0 +1,233 @@
+"""Offline stand-in for the Ngenic Tune API.
+
+Serves a seeded account with a configurable number of tunes, rooms and
+nodes. Measurement histories are generated from the time of the request,
+so any period can be queried without storing the history. Daily measurements
+are split at midnight in the time zone of the query, like the real API.
+"""
+import math
+import re
+from collections import Counter
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from aiohttp import web
+
+# node type -> measurement types, as reported by the real API
+SENSOR_TYPES = ["temperature_C", "humidity_relative_percent"]
+CONTROLLER_TYPES = ["temperature_C", "control_value_C"]
+METER_TYPES = ["power_kW", "energy_kWH"]
+
+# period -> length of each measurement in the period, daily measurements follow the calendar
+PERIODS = {
+    "PT1M": timedelta(minutes=1),
+    "PT15M": timedelta(minutes=15),
+    "PT1H": timedelta(hours=1),
+    "P1D": None
+}
+
+# nodes report a new measurement this often
+REPORT_INTERVAL = timedelta(minutes=5)
+
+class FakeNgenicApi:
+    """A local Ngenic Tune API with seeded tunes, rooms and nodes"""
+
+    def __init__(self, tunes=1, rooms=4, history_days=400):
+        self.requests = Counter()
+        self._history_days = history_days
+        self._tunes = {}
+        self._runner = None
+
+        for t in range(tunes):
+            tune_uuid = "tune-%d" % t
+            rooms_json = []
+            nodes_json = [
+                {"uuid": "%s-controller" % tune_uuid, "type": 1, "types": CONTROLLER_TYPES},
+                {"uuid": "%s-meter" % tune_uuid, "type": 4, "types": METER_TYPES}
+            ]
+            for r in range(rooms):
+                node_uuid = "%s-sensor-%d" % (tune_uuid, r)
+                rooms_json.append({
+                    "uuid": "%s-room-%d" % (tune_uuid, r),
+                    "name": "Room %d" % r,
+                    "nodeUuid": node_uuid,
+                    "activeControl": r == 0,
+                    "targetTemperature": 21.0
+                })
+                nodes_json.append({"uuid": node_uuid, "type": 0, "types": SENSOR_TYPES})
+
+            self._tunes[tune_uuid] = {
+                "tune": {
+                    "uuid": tune_uuid,
+                    "name": "Tune %d" % t,
+                    "tuneName": "Tune %d" % t,
+                    "roomToControlUuid": rooms_json[0]["uuid"] if rooms_json else None,
+                    "rooms": rooms_json
+                },
+                "rooms": rooms_json,
+                "nodes": nodes_json
+            }
+
+    async def async_start(self):
+        """Start the server on a free local port, return the API url"""
+        app = web.Application(middlewares=[self._count])
+        app.router.add_get("/api/v3/tunes/", self._tunes_list, name="tunes")
+        app.router.add_get("/api/v3/tunes/{tune}", self._tune, name="tune")
+        app.router.add_get("/api/v3/tunes/{tune}/rooms/", self._rooms, name="rooms")
+        app.router.add_get("/api/v3/tunes/{tune}/rooms/{room}", self._room, name="room")
+        app.router.add_put("/api/v3/tunes/{tune}/rooms/{room}", self._update_room, name="update_room")
+        app.router.add_get("/api/v3/tunes/{tune}/gateway/nodes/", self._nodes, name="nodes")
+        app.router.add_get("/api/v3/tunes/{tune}/measurements/{node}/types", self._measurement_types, name="measurement_types")
+        app.router.add_get("/api/v3/tunes/{tune}/measurements/{node}/latest", self._latest, name="measurement_latest")
+        app.router.add_get("/api/v3/tunes/{tune}/measurements/{node}", self._measurements, name="measurements")
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return "http://127.0.0.1:%d/api/v3" % port
+
+    async def async_stop(self):
+        await self._runner.cleanup()
+
+    @web.middleware
+    async def _count(self, request, handler):
+        route = request.match_info.route.name or "unknown"
+        self.requests[route] += 1
+        return await handler(request)
+
+    def _get_tune(self, request):
+        tune = self._tunes.get(request.match_info["tune"])
+        if tune is None:
+            raise web.HTTPNotFound()
+        return tune
+
+    def _get_node(self, request):
+        for node in self._get_tune(request)["nodes"]:
+            if node["uuid"] == request.match_info["node"]:
+                return node
+        raise web.HTTPNotFound()
+
+    async def _tunes_list(self, request):
+        return web.json_response([
+            {"tuneUuid": tune["tune"]["uuid"], "tuneName": tune["tune"]["tuneName"]}
+            for tune in self._tunes.values()
+        ])
+
+    async def _tune(self, request):
+        return web.json_response(self._get_tune(request)["tune"])
+
+    async def _rooms(self, request):
+        return web.json_response(self._get_tune(request)["rooms"])
+
+    async def _room(self, request):
+        for room in self._get_tune(request)["rooms"]:
+            if room["uuid"] == request.match_info["room"]:
+                return web.json_response(room)
+        raise web.HTTPNotFound()
+
+    async def _update_room(self, request):
+        body = await request.json()
+        for room in self._get_tune(request)["rooms"]:
+            if room["uuid"] == request.match_info["room"]:
+                room.update(body)
+                return web.Response(status=204)
+        raise web.HTTPNotFound()
+
+    async def _nodes(self, request):
+        return web.json_response([
+            {key: value for key, value in node.items() if key != "types"}
+            for node in self._get_tune(request)["nodes"]
+        ])
+
+    async def _measurement_types(self, request):
+        return web.json_response(self._get_node(request)["types"])
+
+    async def _latest(self, request):
+        self._get_node(request)
+        measurement_type = request.query["type"]
+        measured_at = _latest_report()
+        return web.json_response({
+            "time": measured_at.isoformat(),
+            "value": _value(measurement_type, measured_at)
+        })
+
+    async def _measurements(self, request):
+        self._get_node(request)
+        measurement_type = request.query["type"]
+        from_dt = _parse_datetime(request.query["from"])
+        to_dt = min(_parse_datetime(request.query["to"]), _latest_report())
+        oldest = datetime.now(timezone.utc) - timedelta(days=self._history_days)
+        from_dt = max(from_dt, oldest)
+        if from_dt >= to_dt:
+            return web.Response(status=204)
+
+        period = request.query.get("period")
+        if period is None:
+            return web.json_response({
+                "time": from_dt.isoformat(),
+                "value": _aggregate(measurement_type, from_dt, to_dt)
+            })
+
+        if period not in PERIODS:
+            raise web.HTTPBadRequest(text="Unsupported period %s" % period)
+        step = PERIODS[period]
+        tz = _parse_zone(request.query["from"])
+
+        measurements = []
+        start = from_dt
+        while start < to_dt:
+            if step is None:
+                # days are 23 or 25 hours long when daylight saving time changes
+                local_start = start.astimezone(tz)
+                next_day = datetime.combine(local_start.date() + timedelta(days=1), time.min, tzinfo=tz)
+                end = min(next_day.astimezone(timezone.utc), to_dt)
+                measured_at = datetime.combine(local_start.date(), time.min, tzinfo=tz)
+            else:
+                end = min(start + step, to_dt)
+                measured_at = start
+            measurements.append({
+                "time": measured_at.isoformat(),
+                "value": _aggregate(measurement_type, start, end)
+            })
+            start = end
+        return web.json_response(measurements)
+
+def _latest_report():
+    """Nodes have reported measurements up to this time"""
+    now = datetime.now(timezone.utc)
+    return now - timedelta(seconds=now.timestamp() % REPORT_INTERVAL.total_seconds())
+
+def _parse_datetime(value):
+    """Parse a datetime the way the client formats it, e.g. `2024-01-01T00:00:00 Europe/Stockholm`"""
+    match = re.match(r"^(\S+)[ +](\S+)$", value)
+    if match is None:
+        return datetime.fromisoformat(value).astimezone(timezone.utc)
+    return datetime.fromisoformat(match.group(1)).replace(tzinfo=_parse_zone(value)).astimezone(timezone.utc)
+
+def _parse_zone(value):
+    """Get the time zone of a datetime formatted by the client, UTC if it has none"""
+    match = re.match(r"^(\S+)[ +](\S+)$", value)
+    if match is None:
+        return datetime.fromisoformat(value).tzinfo or timezone.utc
+    zone = match.group(2)
+    return timezone.utc if zone == "Z" else ZoneInfo(zone)
+
+def _value(measurement_type, at):
+    """A deterministic daily curve for every measurement type"""
+    day = 2 * math.pi * (at.timestamp() % 86400) / 86400
+    if measurement_type.startswith("humidity"):
+        return round(40 + 10 * math.sin(day), 1)
+    if measurement_type.startswith("power"):
+        return round(1.5 + math.sin(day), 3)
+    if measurement_type.startswith("control_value"):
+        return round(19 + 3 * math.sin(day), 2)
+    return round(21 + 2 * math.sin(day), 2)
+
+def _aggregate(measurement_type, from_dt, to_dt):
+    """Energy is summed over the period, anything else is averaged"""
+    if measurement_type.startswith("energy"):
+        hours = (to_dt - from_dt).total_seconds() / 3600
+        return round(1.5 * hours, 3)
+    return _value(measurement_type, from_dt + (to_dt - from_dt) / 2)
@@ -0,0 +1,188 @@
+"""Benchmark the Ngenic integration against the offline API.
+
+Sets up the integration in a test instance of Home Assistant, then
+simulates a number of hours of timer ticks and reports the setup time,
+the requests per hour for every endpoint and the peak memory.
+
+    python -m benchmarks.run --tunes 2 --rooms 8 --hours 24
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import tempfile
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import freezegun
+from freezegun import freeze_time
+from freezegun.api import real_perf_counter
+from pytest_homeassistant_custom_component import patch_time  # noqa: F401, makes utcnow patchable
+from pytest_homeassistant_custom_component.common import (
+    MockConfigEntry,
+    async_fire_time_changed,
+    async_test_home_assistant
+)
+from pytest_homeassistant_custom_component.plugins import (
+    HAFakeDatetime,
+    ha_datetime_to_fakedatetime
+)
+
+from homeassistant import loader
+from homeassistant.const import CONF_TOKEN
+
+# the integration is loaded from this repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ngenicpy.models.base
+
+from custom_components.ngenic import climate, sensor
+from custom_components.ngenic.const import DOMAIN, CONF_POWER_HIGH_RESOLUTION
+
+from .fake_api import FakeNgenicApi
+
+# timer ticks are simulated with this resolution
+TICK = timedelta(seconds=10)
+
+# freezegun replaces every module attribute that is a real clock, keep one out of its reach
+_CLOCK = {"perf_counter": real_perf_counter}
+
+def _elapsed(start=0.0):
+    """Wall clock seconds since `start`, unaffected by frozen time"""
+    return _CLOCK["perf_counter"]() - start
+
+async def _async_in_real_time(frozen, awaitable):
+    """Let frozen time follow the wall clock until `awaitable` is done.
+    Requests waiting for the rate limiter would otherwise never be made.
+    """
+    task = asyncio.ensure_future(awaitable)
+    last = _elapsed()
+    while not task.done():
+        await asyncio.sleep(0)
+        now = _elapsed()
+        frozen.tick(timedelta(seconds=now - last))
+        last = now
+    return task.result()
+
+def _timed(timings, name, setup_entry):
+    """Wrap a platform setup to record how long it takes"""
+    async def async_setup_entry(hass, entry, async_add_entities):
+        start = _elapsed()
+        try:
+            return await setup_entry(hass, entry, async_add_entities)
+        finally:
+            timings[name] = _elapsed(start)
+    return async_setup_entry
+
+async def async_run(tunes, rooms, hours, log_level=logging.WARNING, options=None):
+    api = FakeNgenicApi(tunes=tunes, rooms=rooms)
+    ngenicpy.models.base.API_URL = await api.async_start()
+
+    timings = {}
+    sensor.async_setup_entry = _timed(timings, "sensor", sensor.async_setup_entry)
+    climate.async_setup_entry = _timed(timings, "climate", climate.async_setup_entry)
+
+    # let frozen time work with Home Assistant, in the same way as its tests
+    freezegun.api.datetime_to_fakedatetime = ha_datetime_to_fakedatetime
+    freezegun.api.FakeDatetime = HAFakeDatetime
+
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as storage_dir, freeze_time(datetime.now(timezone.utc)) as frozen:
+            async with async_test_home_assistant(storage_dir=storage_dir) as hass:
+                # allow custom integrations, and pretend the recorder is running
+                hass.data.pop(loader.DATA_CUSTOM_COMPONENTS)
+                hass.config.components.add("recorder")
+
+                entry = MockConfigEntry(domain=DOMAIN, data={CONF_TOKEN: "benchmark"}, options=options or {}, title="Benchmark")
+                entry.add_to_hass(hass)
+
+                # the test instance sets up its own logging
+                logging.getLogger().setLevel(log_level)
+
+                start = _elapsed()
+                await _async_in_real_time(frozen, hass.config_entries.async_setup(entry.entry_id))
+                await _async_in_real_time(frozen, hass.async_block_till_done())
+                timings["entry"] = _elapsed(start)
+
+                setup_requests = Counter(api.requests)
+                setup_memory = tracemalloc.get_traced_memory()[1]
+                entities = len(hass.states.async_all())
+
+                api.requests.clear()
+                tracemalloc.reset_peak()
+                for _ in range(int(timedelta(hours=hours) / TICK)):
+                    frozen.tick(TICK)
+                    async_fire_time_changed(hass)
+                    await _async_in_real_time(frozen, hass.async_block_till_done())
+                run_memory = tracemalloc.get_traced_memory()[1]
+
+                await hass.config_entries.async_unload(entry.entry_id)
+                await hass.async_block_till_done()
+                await hass.async_stop(force=True)
+    finally:
+        tracemalloc.stop()
+        await api.async_stop()
+
+    return {
+        "tunes": tunes,
+        "rooms": rooms,
+        "hours": hours,
+        "entities": entities,
+        "setup_seconds": timings,
+        "setup_requests": dict(setup_requests),
+        "requests_per_hour": {
+            endpoint: count / hours
+            for endpoint, count in sorted(api.requests.items())
+        },
+        "peak_memory_setup_bytes": setup_memory,
+        "peak_memory_run_bytes": run_memory
+    }
+
+def _print_report(report):
+    print("%d tunes, %d rooms per tune, %d entities, %g hours" %
+        (report["tunes"], report["rooms"], report["entities"], report["hours"]))
+    print()
+    print("Setup time")
+    for name, seconds in report["setup_seconds"].items():
+        print("  %-22s %8.3f s" % (name, seconds))
+    print()
+    print("Setup requests")
+    for endpoint, count in sorted(report["setup_requests"].items()):
+        print("  %-22s %8d" % (endpoint, count))
+    print("  %-22s %8d" % ("total", sum(report["setup_requests"].values())))
+    print()
+    print("Requests per hour")
+    for endpoint, count in report["requests_per_hour"].items():
+        print("  %-22s %8.1f" % (endpoint, count))
+    print("  %-22s %8.1f" % ("total", sum(report["requests_per_hour"].values())))
+    print()
+    print("Peak memory")
+    print("  %-22s %8.1f MiB" % ("setup", report["peak_memory_setup_bytes"] / 2**20))
+    print("  %-22s %8.1f MiB" % ("run", report["peak_memory_run_bytes"] / 2**20))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tunes", type=int, default=1, help="number of tunes")
+    parser.add_argument("--rooms", type=int, default=4, help="number of rooms (with a sensor) per tune")
+    parser.add_argument("--hours", type=float, default=24, help="simulated hours after setup")
+    parser.add_argument("--high-resolution", action="store_true", help="enable the high resolution power mode")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    parser.add_argument("--verbose", action="store_true", help="log from the integration")
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    logging.basicConfig(level=log_level)
+
+    options = {CONF_POWER_HIGH_RESOLUTION: args.high_resolution}
+    report = asyncio.run(async_run(args.tunes, args.rooms, args.hours, log_level, options))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+
+if __name__ == "__main__":
+    main()
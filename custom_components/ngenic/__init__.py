@@ -4,6 +4,7 @@ import logging
 import voluptuous as vol
 
 from homeassistant.config_entries import SOURCE_IMPORT
+from homeassistant.core import callback
 from homeassistant.helpers import config_validation as cv
 from homeassistant.const import (
     CONF_TOKEN,
@@ -15,9 +16,25 @@ from .services import async_register_services
 from .const import (
     DOMAIN,
     DATA_CLIENT,
+    DATA_API,
     DATA_CONFIG,
-    SERVICE_SET_ACTIVE_CONTROL
+    DATA_TOPOLOGY,
+    DATA_ENERGY_LEDGER,
+    DATA_MEASUREMENT_STORE,
+    DATA_DISCOVERY,
+    DATA_RATE_LIMITER,
+    CONF_SETUP_CONCURRENCY,
+    DEFAULT_SETUP_CONCURRENCY,
+    TOPOLOGY_REFRESH_INTERVAL,
+    SERVICE_SET_ACTIVE_CONTROL,
+    SERVICE_IMPORT_STATISTICS
 )
+from .api import NgenicApi, NgenicClient, NgenicRateLimiter
+from .topology import NgenicTopology
+from .energy import NgenicEnergyLedger
+from .measurement_store import NgenicMeasurementStore
+from .scheduler import async_track_staggered_interval
+from .util import async_loaded_entries
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -40,8 +57,8 @@ NGENIC_PLATFORMS = [
 
 async def async_setup(hass, config):
     """Setup the Ngenic component"""
-    hass.data[DOMAIN] = {}
-    hass.data[DOMAIN][DATA_CLIENT] = {}
+    # the config flow might already have stored discovered topology here
+    hass.data.setdefault(DOMAIN, {})
 
     if DOMAIN not in config:
         return True
@@ -70,28 +87,106 @@ async def async_setup(hass, config):
 
 
 async def async_setup_entry(hass, config_entry):
-    from ngenicpy import AsyncNgenic
-    ngenic = AsyncNgenic(
-        token=config_entry.data[CONF_TOKEN]
+    ngenic = NgenicClient(
+        hass,
+        config_entry.data[CONF_TOKEN],
+        config_entry.options
     )
 
-    hass.data[DOMAIN][DATA_CLIENT] = ngenic
+    # Every config entry (account) has its own client, request layer and state
+    entry_data = hass.data[DOMAIN][config_entry.entry_id] = {}
+    entry_data[DATA_CLIENT] = ngenic
 
+    # All requests are made through the shared request layer,
+    # the rate of requests is limited across all accounts
+    api = NgenicApi(
+        hass,
+        ngenic,
+        hass.data[DOMAIN].setdefault(DATA_RATE_LIMITER, NgenicRateLimiter())
+    )
+    entry_data[DATA_API] = api
+
+    # Load the tunes, rooms and nodes discovered during earlier runs
+    topology = NgenicTopology(
+        hass,
+        api,
+        config_entry.entry_id,
+        config_entry.options.get(CONF_SETUP_CONCURRENCY, DEFAULT_SETUP_CONCURRENCY),
+        hass.data[DOMAIN].get(DATA_DISCOVERY, {}).pop(config_entry.data[CONF_TOKEN], None)
+    )
+    entry_data[DATA_TOPOLOGY] = topology
+    from_storage = await topology.async_load()
+
+    # Load the daily energy consumption of earlier days
+    energy_ledger = NgenicEnergyLedger(hass, api, config_entry.entry_id)
+    await energy_ledger.async_load()
+    entry_data[DATA_ENERGY_LEDGER] = energy_ledger
+
+    # Load the measurements of the last run, so sensors don't have to fetch them again
+    measurement_store = NgenicMeasurementStore(hass, config_entry.entry_id)
+    await measurement_store.async_load()
+    entry_data[DATA_MEASUREMENT_STORE] = measurement_store
 
     # Register Ngenic services
     async_register_services(hass)
+
+    # Reload the entry when its options are changed
+    config_entry.async_on_unload(config_entry.add_update_listener(async_reload_entry))
     
     config_entry.async_create_task(
         hass, hass.config_entries.async_forward_entry_setups(config_entry, NGENIC_PLATFORMS)
     )
 
+    if from_storage:
+        # The stored topology might be outdated, check it against the API
+        # without holding up the setup.
+        config_entry.async_create_background_task(
+            hass, _async_refresh_topology(topology), "ngenic topology refresh"
+        )
+
+    @callback
+    def _async_refresh_topology_interval(now):
+        """Discover new, removed and renamed tunes, rooms and nodes, the platforms apply the changes"""
+        if api.available:
+            config_entry.async_create_background_task(
+                hass, _async_refresh_topology(topology), "ngenic topology refresh"
+            )
+
+    config_entry.async_on_unload(
+        async_track_staggered_interval(hass, config_entry.entry_id, TOPOLOGY_REFRESH_INTERVAL, _async_refresh_topology_interval)
+    )
+
     return True
 
 
+async def _async_refresh_topology(topology):
+    """Refresh the topology, a failure will keep the stored topology."""
+    try:
+        await topology.async_refresh()
+    except Exception:
+        _LOGGER.warning("Failed to refresh Ngenic topology, using stored topology", exc_info=True)
+
+
 async def async_unload_entry(hass, config_entry):
-    await hass.config_entries.async_unload_platforms(config_entry, NGENIC_PLATFORMS)
+    unload_ok = await hass.config_entries.async_unload_platforms(config_entry, NGENIC_PLATFORMS)
 
-    await hass.data[DOMAIN][DATA_CLIENT].async_close()
-    hass.services.async_remove(DOMAIN, SERVICE_SET_ACTIVE_CONTROL)
+    entry_data = hass.data[DOMAIN].pop(config_entry.entry_id)
+    entry_data[DATA_API].async_shutdown()
+    await entry_data[DATA_API].async_cancel_requests()
+    await entry_data[DATA_CLIENT].async_close()
+
+    # the measurements are saved with a long delay, don't lose the latest samples
+    await entry_data[DATA_MEASUREMENT_STORE].async_save()
+
+    # The services are shared by all config entries
+    if not async_loaded_entries(hass):
+        hass.services.async_remove(DOMAIN, SERVICE_SET_ACTIVE_CONTROL)
+        hass.services.async_remove(DOMAIN, SERVICE_IMPORT_STATISTICS)
+
+    return unload_ok
+
+
+async def async_reload_entry(hass, config_entry):
+    """Reload the config entry when its options have been updated."""
+    await hass.config_entries.async_reload(config_entry.entry_id)
 
-    return True
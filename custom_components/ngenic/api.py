@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+from ngenicpy import AsyncNgenic
+from ngenicpy.ngenic import timeout
+
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.httpx_client import create_async_httpx_client
+from homeassistant.util.ssl import get_default_context
+
+from .const import (
+    REQUEST_CACHE_TTL,
+    REQUEST_CACHE_MAX_AGE,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_FAILING_ENDPOINTS,
+    CIRCUIT_PROBE_DELAY,
+    CIRCUIT_MAX_PROBE_DELAY,
+    REQUEST_RATE_LIMIT,
+    REQUEST_RATE_BURST,
+    CONF_MAX_CONNECTIONS,
+    CONF_KEEPALIVE_EXPIRY,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_KEEPALIVE_EXPIRY
+)
+
+from .errors import ApiUnavailable
+from .instrumentation import NgenicApiStats
+
+_LOGGER = logging.getLogger(__name__)
+
+def is_outage(error):
+    """Return if a failed request indicates that the whole API is unreachable.
+    This is the case for transport errors, rejected authentication and server errors,
+    while e.g. a missing resource or an invalid response only concerns a single request.
+    The Ngenic client wraps the httpx error, so the chain of the error is searched.
+    """
+    while error is not None:
+        if isinstance(error, httpx.TransportError):
+            return True
+        if isinstance(error, httpx.HTTPStatusError):
+            status = error.response.status_code
+            return status in (401, 403) or status >= 500
+        error = error.__cause__ or error.__context__
+    return False
+
+class NgenicClient(AsyncNgenic):
+    """Ngenic client using a connection pool created by Home Assistant.
+
+    Connections to the API are kept alive between polls, so most requests
+    reuse a warm connection instead of paying for a new TLS handshake.
+    """
+
+    def __init__(self, hass, token, options):
+        self._token = token
+        self._auth_headers = {"Authorization": "Bearer %s" % self._token}
+
+        self._transport = httpx.AsyncHTTPTransport(
+            verify=get_default_context(),
+            limits=httpx.Limits(
+                max_connections=options.get(CONF_MAX_CONNECTIONS, DEFAULT_MAX_CONNECTIONS),
+                max_keepalive_connections=options.get(CONF_MAX_CONNECTIONS, DEFAULT_MAX_CONNECTIONS),
+                keepalive_expiry=options.get(CONF_KEEPALIVE_EXPIRY, DEFAULT_KEEPALIVE_EXPIRY)
+            )
+        )
+        # the client is closed with the entry rather than when Home Assistant stops,
+        # as every reload of the entry creates a new client
+        session = create_async_httpx_client(hass, auto_cleanup=False, transport=self._transport, timeout=timeout)
+        session.headers.update(self._auth_headers)
+
+        # skip AsyncNgenic.__init__ as it would create its own session
+        super(AsyncNgenic, self).__init__(session=session)
+
+    async def async_close(self):
+        """Close the session and all pooled connections"""
+        # Home Assistant replaces aclose of its clients with a warning, this client is our own
+        await httpx.AsyncClient.aclose(self._session)
+
+class NgenicRateLimiter:
+    """Limit the rate of requests, shared by the request layers of all accounts.
+
+    Requests are spaced evenly at `rate` requests per second, but a burst of
+    up to `burst` requests is let through at once after a quiet period.
+    """
+
+    def __init__(self, rate=REQUEST_RATE_LIMIT, burst=REQUEST_RATE_BURST):
+        self._interval = 1 / rate
+        self._burst = burst
+
+        # the theoretical arrival time of the next request, in loop time
+        self._next = 0.0
+
+    async def async_acquire(self):
+        """Wait until a request may be made"""
+        now = asyncio.get_running_loop().time()
+        send_at = max(now, self._next - (self._burst - 1) * self._interval)
+        self._next = max(self._next, now) + self._interval
+
+        if send_at > now:
+            _LOGGER.debug("Rate limited, waiting %.2f seconds" % (send_at - now))
+            await asyncio.sleep(send_at - now)
+
+class NgenicApi:
+    """Shared request layer in front of the Ngenic client.
+
+    Identical requests that are in flight at the same time are coalesced,
+    so concurrent callers await a single HTTP request. Results are kept in
+    a short lived cache, callers decide how old a result they accept with
+    `max_age` (defaults to REQUEST_CACHE_TTL).
+
+    Every request that reaches the API is recorded in `stats`, with its
+    latency and whether it failed.
+
+    Consecutive failures that indicate an outage, counted per endpoint, open
+    a circuit breaker once several endpoints are failing, so a single broken
+    endpoint doesn't make the whole account unavailable. While it is open,
+    requests that can't be served from the cache fail at once with `ApiUnavailable`
+    and the API is probed by listing tunes with exponential backoff.
+    Listeners are told when the API becomes unavailable and when it has recovered.
+
+    Requests wait for the optional `NgenicRateLimiter` before they are made.
+    """
+
+    def __init__(self, hass, ngenic, limiter=None):
+        self._hass = hass
+        self._ngenic = ngenic
+        self._limiter = limiter
+
+        # key -> task of the request in flight
+        self._in_flight = {}
+
+        # key -> (monotonic time of the response, result)
+        self._cache = {}
+
+        self.stats = NgenicApiStats()
+
+        # circuit breaker, endpoint -> consecutive failures indicating an outage
+        self._failures = {}
+        self._available = True
+        self._probe_delay = CIRCUIT_PROBE_DELAY
+        self._cancel_probe = None
+        self._listeners = []
+
+    @property
+    def client(self):
+        """Return the Ngenic client"""
+        return self._ngenic
+
+    async def async_tunes(self, max_age=REQUEST_CACHE_TTL):
+        """List all tunes"""
+        return await self._async_request(
+            ("tunes",),
+            self._ngenic.async_tunes,
+            max_age
+        )
+
+    async def async_tune(self, tune_uuid, max_age=REQUEST_CACHE_TTL):
+        """Get a single tune, this contain more information than when listing tunes"""
+        return await self._async_request(
+            ("tune", tune_uuid),
+            lambda: self._ngenic.async_tune(tune_uuid),
+            max_age
+        )
+
+    async def async_rooms(self, tune, max_age=REQUEST_CACHE_TTL):
+        """List all rooms of a tune"""
+        return await self._async_request(
+            ("rooms", tune.uuid()),
+            tune.async_rooms,
+            max_age
+        )
+
+    async def async_room(self, tune, room_uuid, max_age=REQUEST_CACHE_TTL):
+        """Get a single room of a tune"""
+        return await self._async_request(
+            ("room", tune.uuid(), room_uuid),
+            lambda: tune.async_room(room_uuid),
+            max_age
+        )
+
+    async def async_nodes(self, tune, max_age=REQUEST_CACHE_TTL):
+        """List all nodes of a tune"""
+        return await self._async_request(
+            ("nodes", tune.uuid()),
+            tune.async_nodes,
+            max_age
+        )
+
+    async def async_measurement_types(self, node, max_age=REQUEST_CACHE_TTL):
+        """List the measurement types of a node"""
+        return await self._async_request(
+            ("measurement_types", node.uuid()),
+            node.async_measurement_types,
+            max_age
+        )
+
+    async def async_measurement(self, node, measurement_type, from_dt=None, to_dt=None, period=None, max_age=REQUEST_CACHE_TTL, cache=True):
+        """Get the latest measurement of a node, or the measurements for a period.
+        Set `cache` to False for large results that no one else will ask for.
+        """
+        return await self._async_request(
+            ("measurement_latest" if from_dt is None else "measurements", node.uuid(), measurement_type.value, from_dt, to_dt, period),
+            lambda: node.async_measurement(measurement_type, from_dt=from_dt, to_dt=to_dt, period=period),
+            max_age,
+            cache
+        )
+
+    async def async_update_room(self, tune, room):
+        """Update a room with its current values.
+        Cached rooms of the tune are invalidated.
+        """
+        if not self._available:
+            raise ApiUnavailable("Ngenic API is unavailable (request=update_room)")
+        await self._async_timed("update_room", room.async_update)
+        self.invalidate(("rooms", tune.uuid()))
+        self.invalidate(("room", tune.uuid(), room.uuid()))
+
+    @property
+    def available(self):
+        """Return False while the circuit breaker is open"""
+        return self._available
+
+    @callback
+    def async_add_listener(self, listener):
+        """Listen for changes of availability.
+        The listener is called with True when the API has recovered
+        and False when it has become unavailable.
+        Return a function that removes the listener.
+        """
+        self._listeners.append(listener)
+
+        @callback
+        def remove_listener():
+            self._listeners.remove(listener)
+
+        return remove_listener
+
+    @callback
+    def async_shutdown(self):
+        """Stop probing the API"""
+        if self._cancel_probe is not None:
+            self._cancel_probe()
+            self._cancel_probe = None
+
+    async def async_cancel_requests(self):
+        """Cancel all requests in flight, e.g. when their callers have given up waiting.
+        Requests are shielded from their callers, so they would otherwise outlive the client.
+        """
+        tasks = list(self._in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def invalidate(self, key):
+        """Remove a cached result"""
+        self._cache.pop(key, None)
+
+    async def _async_request(self, key, request, max_age, cache=True):
+        """Make a request, or wait for an identical request in flight.
+        A cached result is returned if it is not older than `max_age`.
+        """
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] <= max_age.total_seconds():
+            _LOGGER.debug("Using cached result for %s" % (key,))
+            self.stats.cache_hits += 1
+            return cached[1]
+
+        if not self._available:
+            raise ApiUnavailable("Ngenic API is unavailable (request=%s)" % (key,))
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._hass.async_create_task(self._async_fetch(key, request, cache))
+            self._in_flight[key] = task
+        else:
+            _LOGGER.debug("Waiting for request in flight for %s" % (key,))
+            self.stats.coalesced += 1
+
+        # a cancelled caller must not cancel the request for other callers
+        return await asyncio.shield(task)
+
+    async def _async_fetch(self, key, request, cache):
+        try:
+            # the first part of the key is the endpoint
+            result = await self._async_timed(key[0], request)
+        finally:
+            self._in_flight.pop(key, None)
+
+        if not cache:
+            return result
+
+        now = time.monotonic()
+        self._cache[key] = (now, result)
+
+        # forget results that are too old to be used by anyone
+        for expired in [k for k, (fetched, _) in self._cache.items() if now - fetched > REQUEST_CACHE_MAX_AGE.total_seconds()]:
+            del self._cache[expired]
+
+        return result
+
+    async def _async_timed(self, endpoint, request):
+        """Make a request and record it in the stats of the endpoint"""
+        if self._limiter is not None:
+            await self._limiter.async_acquire()
+
+        start = time.monotonic()
+        try:
+            result = await request()
+        except Exception as error:
+            self.stats.record(endpoint, time.monotonic() - start, error)
+            self._async_failure(endpoint, error)
+            raise
+        self.stats.record(endpoint, time.monotonic() - start)
+        self._failures.pop(endpoint, None)
+        return result
+
+    @callback
+    def _async_failure(self, endpoint, error):
+        """Open the circuit breaker when requests to several endpoints have failed in a row"""
+        if not is_outage(error):
+            # the API has answered, the request itself is at fault
+            self._failures.pop(endpoint, None)
+            return
+
+        self._failures[endpoint] = self._failures.get(endpoint, 0) + 1
+        failures = sum(self._failures.values())
+        if (
+            not self._available
+            or len(self._failures) < CIRCUIT_FAILING_ENDPOINTS
+            or failures < CIRCUIT_FAILURE_THRESHOLD
+        ):
+            return
+
+        _LOGGER.warning("Ngenic API is unavailable after %d failed requests to %s, probing again in %s" %
+            (failures, ", ".join(sorted(self._failures)), self._probe_delay))
+        self._available = False
+        self._schedule_probe()
+        self._notify_listeners()
+
+    def _schedule_probe(self):
+        self._cancel_probe = async_call_later(self._hass, self._probe_delay, self._async_probe)
+
+    async def _async_probe(self, now=None):
+        """Probe the API with a request without side effects.
+        The circuit breaker is closed on any answer that doesn't indicate an outage,
+        e.g. an error about the request itself means the API is reachable.
+        """
+        self._cancel_probe = None
+        try:
+            await self._async_timed("tunes", self._ngenic.async_tunes)
+        except Exception as error:
+            if is_outage(error):
+                self._probe_delay = min(self._probe_delay * 2, CIRCUIT_MAX_PROBE_DELAY)
+                _LOGGER.debug("Ngenic API is still unavailable (%s), probing again in %s" % (error, self._probe_delay))
+                self._schedule_probe()
+                return
+            _LOGGER.debug("Ngenic API answered the probe with an error (%s)" % error)
+
+        _LOGGER.warning("Ngenic API has recovered")
+        self._available = True
+        self._failures = {}
+        self._probe_delay = CIRCUIT_PROBE_DELAY
+        self._notify_listeners()
+
+    def _notify_listeners(self):
+        for listener in list(self._listeners):
+            listener(self._available)
@@ -1,82 +1,161 @@
+import asyncio
 import logging
+import time
 from datetime import timedelta
 
 from ngenicpy.models.measurement import MeasurementType
 
-from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.restore_state import RestoreEntity
 from homeassistant.components.climate import ClimateEntity
 from homeassistant.components.climate.const import (
+    ATTR_CURRENT_TEMPERATURE,
     ClimateEntityFeature,
     HVACMode
 )
 from homeassistant.const import (
+    STATE_UNAVAILABLE,
     UnitOfTemperature,
     ATTR_TEMPERATURE
 )
 
 from .const import (
     DOMAIN,
-    DATA_CLIENT
+    DATA_CLIENT,
+    DATA_API,
+    DATA_TOPOLOGY,
+    CONF_SETPOINT_DEBOUNCE,
+    DEFAULT_SETPOINT_DEBOUNCE,
+    SCAN_INTERVAL,
+    TOPOLOGY_RETIRE_REFRESHES
 )
+from .errors import ApiUnavailable
+from .scheduler import async_track_staggered_interval
 
 _LOGGER = logging.getLogger(__name__)
 
 async def async_setup_entry(hass, entry, async_add_entities):
-    """Set up the sensor platform."""
-
-    ngenic = hass.data[DOMAIN][DATA_CLIENT]
-
-    devices = []
-    
-    for tmp_tune in await ngenic.async_tunes():
-        # listing tunes contain less information than when querying a single tune
-        tune = await ngenic.async_tune(tmp_tune.uuid())
+    """Set up the climate platform.
+    Thermostats are added at once with the state of the last run,
+    and are updated in the background as soon as they have been added.
+    The thermostats follow the topology when it changes, without a reload.
+    """
+    start = time.monotonic()
+
+    entry_data = hass.data[DOMAIN][entry.entry_id]
+    ngenic = entry_data[DATA_CLIENT]
+    api = entry_data[DATA_API]
+    topology = entry_data[DATA_TOPOLOGY]
+
+    # control node uuid -> NgenicTune
+    thermostats = {}
+
+    # control node uuid -> refresh of the topology it was first missing from
+    missing = {}
+
+    @callback
+    def async_apply_topology():
+        """Add thermostats of new control rooms and update the others in place.
+        The thermostats of rooms that are no longer controlled are unavailable, and are
+        retired once they have been missing for TOPOLOGY_RETIRE_REFRESHES refreshes.
+        """
+        devices = []
+        node_uuids = set()
+        for tune, control_room, control_node in _get_control_rooms(topology):
+            node_uuids.add(control_node.uuid())
+            thermostat = thermostats.get(control_node.uuid())
+            if thermostat is not None:
+                if missing.pop(control_node.uuid(), None) is not None:
+                    _LOGGER.info("Thermostat %s is back in the topology" % thermostat.unique_id)
+                thermostat.async_update_topology(tune, control_room)
+                continue
+
+            thermostat = thermostats[control_node.uuid()] = NgenicTune(
+                hass,
+                ngenic,
+                api,
+                tune,
+                control_room,
+                control_node,
+                entry.options.get(CONF_SETPOINT_DEBOUNCE, DEFAULT_SETPOINT_DEBOUNCE)
+            )
+            devices.append(thermostat)
+
+        registry = er.async_get(hass)
+        for node_uuid in thermostats.keys() - node_uuids:
+            thermostat = thermostats[node_uuid]
+            if node_uuid not in missing:
+                _LOGGER.info("Thermostat %s is missing from the topology" % thermostat.unique_id)
+                missing[node_uuid] = topology.refreshes
+                thermostat.async_set_missing()
+            if topology.refreshes - missing[node_uuid] + 1 < TOPOLOGY_RETIRE_REFRESHES:
+                continue
+
+            del thermostats[node_uuid], missing[node_uuid]
+            _LOGGER.info("Retiring thermostat %s" % thermostat.unique_id)
+            if thermostat.entity_id is not None and registry.async_get(thermostat.entity_id) is not None:
+                # the entity removes itself when it is removed from the registry
+                registry.async_remove(thermostat.entity_id)
+            elif thermostat.hass is not None:
+                hass.async_create_task(thermostat.async_remove())
+
+        if devices:
+            async_add_entities(devices)
+
+    async_apply_topology()
+    entry.async_on_unload(topology.async_add_listener(async_apply_topology))
+
+    _LOGGER.info("Setup of %d thermostats took %.2f seconds" % (len(thermostats), time.monotonic() - start))
+
+def _get_control_rooms(topology):
+    """Get the rooms whose sensor data and target temperature are used by the Tune control system.
+    Return a list of (tune, control room, control node) tuples.
+    """
+    control_rooms = []
+    for tune_topology in topology.tunes:
+        tune = tune_topology.tune
 
         # rooms with control sensors can be found either directly on the tune, or by looking at the activeControl
         # property on the room object. if roomToControlUuid is set, it takes precedence and the activeControl
-        # attribute will not be used
+        # attribute will not be used.
+        # the room models are used rather than the rooms in the tune json, as they are kept up to date
+        # when active control is set by the service
         control_room_uuids = []
         if tune["roomToControlUuid"]:
             control_room_uuids.append(tune["roomToControlUuid"])
         else:
-            for room in tune["rooms"]:
+            for room in tune_topology.rooms:
                 if room["activeControl"] is True:
-                    control_room_uuids.append(room['uuid'])
+                    control_room_uuids.append(room.uuid())
 
         for control_room_uuid in control_room_uuids:
             # get the room whose sensor data and target temperature should be used as inputs to the Tune control system
-            control_room = await tune.async_room(control_room_uuid)
+            control_room = tune_topology.room(control_room_uuid)
+            if control_room is None:
+                _LOGGER.warning("Control room %s was not found in tune %s" % (control_room_uuid, tune.uuid()))
+                continue
 
             # get the room node
-            control_node = await tune.async_node(control_room["nodeUuid"])
+            control_node = tune_topology.node(control_room["nodeUuid"])
+            if control_node is None:
+                _LOGGER.warning("Node of control room %s was not found in tune %s" % (control_room_uuid, tune.uuid()))
+                continue
 
-            device = NgenicTune(
-                hass,
-                ngenic,
-                tune,
-                control_room,
-                control_node
-            )
+            control_rooms.append((tune, control_room, control_node))
 
-            # Initial update
-            await device._async_update()
+    return control_rooms
 
-            # Setup update timer
-            device._setup_updater()
-
-            devices.append(device)
-
-    async_add_entities(devices)
-
-class NgenicTune(ClimateEntity):
+class NgenicTune(ClimateEntity, RestoreEntity):
     """Representation of an Ngenic Thermostat"""
 
-    def __init__(self, hass, ngenic, tune, control_room, control_node):
+    def __init__(self, hass, ngenic, api, tune, control_room, control_node, setpoint_debounce=DEFAULT_SETPOINT_DEBOUNCE):
         """Initialize the thermostat."""
         self._hass = hass
         self._available = False
         self._ngenic = ngenic
-        self._name =  "Ngenic Tune %s" % (tune["name"])
+        self._api = api
         self._tune = tune
         self._room = control_room
         self._node = control_node
@@ -84,6 +163,16 @@ class NgenicTune(ClimateEntity):
         self._target_temperature = None
         self._updater = None
 
+        # the control room is missing from the topology, the thermostat is unavailable until it is back
+        self._missing = False
+
+        # target temperature set by the user that has not been written to the API yet,
+        # it is written once it hasn't changed for `setpoint_debounce` seconds
+        self._pending_target = None
+        self._setpoint_debounce = setpoint_debounce
+        self._cancel_setpoint_write = None
+        self._setpoint_lock = asyncio.Lock()
+
     @property
     def supported_features(self):
         """Return the list of supported features."""
@@ -92,11 +181,11 @@ class NgenicTune(ClimateEntity):
     @property
     def name(self):
         """Return the name of the Tune."""
-        return self._name
+        return "Ngenic Tune %s" % (self._tune["name"])
 
     @property
     def available(self):
-        return self._available
+        return self._available and not self._missing
 
     @property
     def unique_id(self):
@@ -127,35 +216,157 @@ class NgenicTune(ClimateEntity):
         """Must be implemented"""
         return [HVACMode.HEAT]
 
+    @callback
+    def async_update_topology(self, tune, control_room):
+        """Follow a renamed tune, or a control node that was moved to another room"""
+        self._tune = tune
+        self._room = control_room
+        if self._missing:
+            self._missing = False
+            if self.hass is not None:
+                self._hass.async_create_task(self._async_update_and_write_state())
+                return
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    @callback
+    def async_set_missing(self):
+        """Become unavailable while the control room is missing from the topology"""
+        self._missing = True
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    async def async_added_to_hass(self):
+        """Restore the state of the last run, then update in the background.
+        Setup the update timer and follow the availability of the API.
+        The timer is not started before the entity has been added, e.g. a
+        thermostat that is also set up by another account will never be added.
+        """
+        last_state = await self.async_get_last_state()
+        if last_state is not None and last_state.state != STATE_UNAVAILABLE:
+            self._current_temperature = last_state.attributes.get(ATTR_CURRENT_TEMPERATURE)
+            self._target_temperature = last_state.attributes.get(ATTR_TEMPERATURE)
+            self._available = True
+
+        # Initial update, Home Assistant doesn't wait for it to finish starting
+        update = self._hass.async_create_background_task(
+            self._async_update_and_write_state(),
+            "ngenic update %s" % self.unique_id
+        )
+        self.async_on_remove(update.cancel)
+
+        self._setup_updater()
+        self.async_on_remove(self._api.async_add_listener(self._async_api_availability_changed))
+
+    @callback
+    def _async_api_availability_changed(self, available):
+        """Become unavailable at once, or update once the API has recovered"""
+        if available:
+            self._hass.async_create_task(self._async_update_and_write_state())
+            return
+
+        self._available = False
+        self.async_write_ha_state()
+
+    async def _async_update_and_write_state(self):
+        await self._async_update()
+        self.async_write_ha_state()
+
     async def async_will_remove_from_hass(self):
-        """Remove updater when sensor is removed."""
+        """Remove updater when sensor is removed.
+        A target temperature that is waiting to be written is written at once.
+        """
         if self._updater:
             self._updater()
             self._updater = None
 
+        if self._cancel_setpoint_write is not None:
+            self._cancel_setpoint_write()
+            self._cancel_setpoint_write = None
+        await self._async_write_setpoint()
+
     def _setup_updater(self):
-        """Setup a timer that will execute an update every update interval"""
-        # async_track_time_interval returns a function that, when executed, will remove the timer
-        self._updater = async_track_time_interval(self._hass, self._async_update, timedelta(minutes=5))
+        """Setup a timer that will execute an update every update interval.
+        Each thermostat updates at its own offset within the interval.
+        """
+        # async_track_staggered_interval returns a function that, when executed, will remove the timer
+        self._updater = async_track_staggered_interval(self._hass, self.unique_id, SCAN_INTERVAL, self._async_update)
 
     async def async_set_temperature(self, **kwargs):
-        """Set new target temperature."""
+        """Set new target temperature.
+        The thermostat shows the new target at once, while the write to the API
+        waits for the target to settle, e.g. while a slider is being dragged.
+        Every new target restarts the wait, so a single target is written per change.
+        """
         temperature = kwargs.get(ATTR_TEMPERATURE)
         if temperature is None:
             return
 
-        self._room["targetTemperature"] = temperature
-        await self._room.async_update()
+        self._pending_target = temperature
         self._target_temperature = temperature
+        self.async_write_ha_state()
+
+        if self._cancel_setpoint_write is not None:
+            self._cancel_setpoint_write()
+        self._cancel_setpoint_write = async_call_later(self._hass, self._setpoint_debounce, self._async_setpoint_settled)
+
+    async def _async_setpoint_settled(self, now):
+        self._cancel_setpoint_write = None
+        await self._async_write_setpoint()
+
+    async def _async_write_setpoint(self):
+        """Write the pending target temperature, if any, then read it back from the API.
+        A target that was set while writing is written before reading back.
+        The room is written as a whole, so the current room is fetched first
+        rather than writing the room of the topology, which could be outdated.
+        """
+        async with self._setpoint_lock:
+            if self._pending_target is not None:
+                await self._async_write_pending_setpoint()
+
+    async def _async_write_pending_setpoint(self):
+        temperature = self._pending_target
+        try:
+            room = await self._api.async_room(self._tune, self._room.uuid(), max_age=timedelta(0))
+            while temperature is not None:
+                room["targetTemperature"] = temperature
+                await self._api.async_update_room(self._tune, room)
+                if self._pending_target == temperature:
+                    break
+                temperature = self._pending_target
+
+            self._pending_target = None
+            target_room = await self._api.async_room(self._tune, self._room.uuid())
+        except Exception:
+            # show the target temperature of the API again
+            _LOGGER.exception("Failed to set target temperature of climate '%s'" % self.unique_id)
+            self._pending_target = None
+            await self._async_update_and_write_state()
+            return
+
+        self._target_temperature = round(target_room["targetTemperature"], 1)
+        self.async_write_ha_state()
 
     async def _async_update(self, event_time=None):
         """Fetch new state data from the sensor.
         This is the only method that should fetch new data for Home Assistant.
         """
+        if self._missing:
+            return
+        if not self._api.available:
+            self._available = False
+            return
+
         try:
-            current = await self._node.async_measurement(MeasurementType.TEMPERATURE)
-            target_room = await self._tune.async_room(self._room.uuid())
+            # the temperature sensor of the control node fetches the same measurement,
+            # use its result if it was fetched since our last update
+            current = await self._api.async_measurement(self._node, MeasurementType.TEMPERATURE, max_age=SCAN_INTERVAL)
+            target_room = await self._api.async_room(self._tune, self._room.uuid())
             self._available = True
+        except ApiUnavailable:
+            # the API became unavailable during the update, this has already been logged
+            self._available = False
+            return
         except Exception:
             # Don't throw an exception if a sensor fails to update.
             # Instead, make the sensor unavailable.
@@ -164,4 +375,7 @@ class NgenicTune(ClimateEntity):
             return
 
         self._current_temperature = round(current["value"], 1)
-        self._target_temperature = round(target_room["targetTemperature"], 1)
+
+        # don't revert a target temperature that is waiting to be written
+        if self._pending_target is None:
+            self._target_temperature = round(target_room["targetTemperature"], 1)
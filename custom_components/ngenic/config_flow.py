@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from datetime import timedelta
 
@@ -10,10 +11,32 @@ from homeassistant.const import (
     CONF_TOKEN
 )
 
-from .const import DOMAIN
+from .const import (
+    DOMAIN,
+    DATA_DISCOVERY,
+    VALIDATION_TIMEOUT,
+    CONF_SETUP_CONCURRENCY,
+    CONF_MAX_CONNECTIONS,
+    CONF_KEEPALIVE_EXPIRY,
+    CONF_SETPOINT_DEBOUNCE,
+    CONF_POWER_HIGH_RESOLUTION,
+    DEFAULT_SETUP_CONCURRENCY,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_KEEPALIVE_EXPIRY,
+    DEFAULT_SETPOINT_DEBOUNCE,
+    DEFAULT_POWER_HIGH_RESOLUTION,
+    SENSOR_CLASSES,
+    CONF_DEADBAND,
+    CONF_DEADBAND_PERCENT,
+    CONF_MIN_WRITE_INTERVAL,
+    CONF_HEARTBEAT,
+    DEFAULT_STATE_WRITES
+)
 from .errors import AlreadyConfigured, NoTunes
+from .api import NgenicApi, NgenicClient
+from .topology import async_discover_topology
+from .state_filter import option_key
 
-from ngenicpy import Ngenic
 from ngenicpy.exceptions import ClientException
 
 _LOGGER = logging.getLogger(__name__)
@@ -31,6 +54,12 @@ class FlowHandler(config_entries.ConfigFlow):
     VERSION = 1
     CONNECTION_CLASS = config_entries.CONN_CLASS_CLOUD_PUSH
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        """Get the options flow for this handler."""
+        return OptionsFlowHandler(config_entry)
+
     async def async_step_import(self, import_config):
         """Import a config entry from configuration.yaml."""
         return await self.async_step_user(import_config)
@@ -45,18 +74,31 @@ class FlowHandler(config_entries.ConfigFlow):
                 if user_input[CONF_TOKEN] in configured_instances(self.hass):
                     raise AlreadyConfigured
 
-                ngenic = Ngenic(
-                    token=user_input[CONF_TOKEN]
-                )
+                ngenic = NgenicClient(self.hass, user_input[CONF_TOKEN], {})
+                api = NgenicApi(self.hass, ngenic)
+                try:
+                    async with asyncio.timeout(VALIDATION_TIMEOUT):
+                        tunes_json = await async_discover_topology(
+                            api,
+                            DEFAULT_SETUP_CONCURRENCY
+                        )
+                finally:
+                    # requests still in flight when the validation timed out
+                    await api.async_cancel_requests()
+                    await ngenic.async_close()
 
                 tune_name = None
-                
-                for tune in ngenic.tunes():
-                    tune_name = tune["tuneName"]
+
+                for tune_json in tunes_json:
+                    tune_name = tune_json["tune"]["tuneName"]
         
                 if tune_name is None:
                     raise NoTunes
 
+                # hand the discovered topology to the setup of the entry,
+                # so it doesn't have to be discovered again
+                self.hass.data.setdefault(DOMAIN, {}).setdefault(DATA_DISCOVERY, {})[user_input[CONF_TOKEN]] = tunes_json
+
                 return self.async_create_entry(
                     title=tune_name, data=user_input
                 )
@@ -64,6 +106,9 @@ class FlowHandler(config_entries.ConfigFlow):
             except ClientException:
                 errors["base"] = "bad_token"
 
+            except asyncio.TimeoutError:
+                errors["base"] = "timeout"
+
             except AlreadyConfigured:
                 errors["base"] = "already_configured"
             
@@ -79,4 +124,80 @@ class FlowHandler(config_entries.ConfigFlow):
             errors=errors
         )
 
-        
\ No newline at end of file
+        
+
+class OptionsFlowHandler(config_entries.OptionsFlow):
+    """Handle Ngenic options."""
+
+    def __init__(self, config_entry):
+        self.config_entry = config_entry
+        self._options = dict(config_entry.options)
+
+    async def async_step_init(self, user_input=None):
+        """Manage the options of the connection to the API."""
+        if user_input is not None:
+            self._options.update(user_input)
+            return await self.async_step_sensors()
+
+        options = self.config_entry.options
+
+        return self.async_show_form(
+            step_id="init",
+            data_schema=vol.Schema({
+                vol.Optional(
+                    CONF_SETUP_CONCURRENCY,
+                    default=options.get(CONF_SETUP_CONCURRENCY, DEFAULT_SETUP_CONCURRENCY)
+                ): vol.All(vol.Coerce(int), vol.Range(min=1, max=64)),
+                vol.Optional(
+                    CONF_MAX_CONNECTIONS,
+                    default=options.get(CONF_MAX_CONNECTIONS, DEFAULT_MAX_CONNECTIONS)
+                ): vol.All(vol.Coerce(int), vol.Range(min=1, max=100)),
+                vol.Optional(
+                    CONF_KEEPALIVE_EXPIRY,
+                    default=options.get(CONF_KEEPALIVE_EXPIRY, DEFAULT_KEEPALIVE_EXPIRY)
+                ): vol.All(vol.Coerce(int), vol.Range(min=0, max=3600)),
+                vol.Optional(
+                    CONF_SETPOINT_DEBOUNCE,
+                    default=options.get(CONF_SETPOINT_DEBOUNCE, DEFAULT_SETPOINT_DEBOUNCE)
+                ): vol.All(vol.Coerce(float), vol.Range(min=0, max=60))
+            })
+        )
+
+    async def async_step_sensors(self, user_input=None):
+        """Manage the options of the state writes, per sensor class."""
+        if user_input is not None:
+            self._options.update(user_input)
+            return self.async_create_entry(title="", data=self._options)
+
+        schema = {}
+        for sensor_class in SENSOR_CLASSES:
+            defaults = DEFAULT_STATE_WRITES[sensor_class]
+
+            def default(option):
+                return self._options.get(option_key(sensor_class, option), defaults[option])
+
+            schema.update({
+                vol.Optional(
+                    option_key(sensor_class, CONF_DEADBAND),
+                    default=default(CONF_DEADBAND)
+                ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+                vol.Optional(
+                    option_key(sensor_class, CONF_DEADBAND_PERCENT),
+                    default=default(CONF_DEADBAND_PERCENT)
+                ): vol.All(vol.Coerce(float), vol.Range(min=0, max=100)),
+                vol.Optional(
+                    option_key(sensor_class, CONF_MIN_WRITE_INTERVAL),
+                    default=default(CONF_MIN_WRITE_INTERVAL)
+                ): vol.All(vol.Coerce(int), vol.Range(min=0, max=86400)),
+                vol.Optional(
+                    option_key(sensor_class, CONF_HEARTBEAT),
+                    default=default(CONF_HEARTBEAT)
+                ): vol.All(vol.Coerce(int), vol.Range(min=0, max=86400))
+            })
+
+        schema[vol.Optional(
+            CONF_POWER_HIGH_RESOLUTION,
+            default=self._options.get(CONF_POWER_HIGH_RESOLUTION, DEFAULT_POWER_HIGH_RESOLUTION)
+        )] = bool
+
+        return self.async_show_form(step_id="sensors", data_schema=vol.Schema(schema))
@@ -2,9 +2,23 @@ from datetime import timedelta
 
 DOMAIN = "ngenic"
 DATA_CLIENT = "data_client"
+DATA_API = "api"
 DATA_CONFIG = "config"
+DATA_TOPOLOGY = "topology"
+DATA_ENERGY_LEDGER = "energy_ledger"
+DATA_MEASUREMENT_STORE = "measurement_store"
+DATA_DISCOVERY = "discovery"
+DATA_RATE_LIMITER = "rate_limiter"
+
+STORAGE_VERSION = 1
 
 SERVICE_SET_ACTIVE_CONTROL = "set_active_control"
+SERVICE_IMPORT_STATISTICS = "import_statistics"
+
+"""
+Time allowed to validate the token and discover the topology in the config flow.
+"""
+VALIDATION_TIMEOUT = 30
 
 """
 How often to re-scan sensor information.
@@ -12,3 +26,164 @@ From API doc: Tune system Nodes generally report data in intervals of five
 minutes, so there is no point in polling the API for new data at a higher rate.
 """
 SCAN_INTERVAL = timedelta(minutes=5)
+
+"""
+Measurements that are reported by nodes are polled this long after a report is expected.
+If no new report was found, the delay is doubled for each poll up to REPORT_MAX_BACKOFF.
+"""
+REPORT_POLL_DELAY = timedelta(seconds=30)
+REPORT_MIN_INTERVAL = timedelta(seconds=30)
+REPORT_MAX_BACKOFF = timedelta(minutes=30)
+
+"""
+How often the tunes, rooms and nodes are discovered again. New nodes and measurement
+types get entities, removed ones are retired and renamed rooms and tunes are renamed.
+"""
+TOPOLOGY_REFRESH_INTERVAL = timedelta(hours=1)
+
+"""
+Entities of nodes, measurement types and control rooms that are missing from the topology
+are unavailable, and are only removed once they have been missing for this many refreshes.
+"""
+TOPOLOGY_RETIRE_REFRESHES = 3
+
+"""
+How long a response is reused for identical requests, unless the caller accepts older results.
+Responses older than REQUEST_CACHE_MAX_AGE are never reused.
+"""
+REQUEST_CACHE_TTL = timedelta(seconds=30)
+REQUEST_CACHE_MAX_AGE = timedelta(minutes=10)
+
+"""
+Maximum number of API requests run concurrently while setting up the platforms.
+"""
+CONF_SETUP_CONCURRENCY = "setup_concurrency"
+DEFAULT_SETUP_CONCURRENCY = 8
+
+"""
+Connection pool to the Ngenic API.
+All connections are kept alive for `keepalive_expiry` seconds after a request.
+"""
+CONF_MAX_CONNECTIONS = "max_connections"
+CONF_KEEPALIVE_EXPIRY = "keepalive_expiry"
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY = 60
+
+"""
+Seconds to wait for more changes of a thermostat's target temperature before it is written.
+Only the last target temperature within the window is sent to the API.
+"""
+CONF_SETPOINT_DEBOUNCE = "setpoint_debounce"
+DEFAULT_SETPOINT_DEBOUNCE = 2
+
+"""
+State writes of the measurement sensors, configured per sensor class.
+A new value is only written when it differs from the written value by at least
+`deadband` (in the unit of the sensor) and `deadband_percent`, and not sooner than
+`min_write_interval` seconds after the last write. A value that has changed
+is always written `heartbeat` seconds after the last write, 0 disables the heartbeat.
+Options are named by the sensor class and the option, e.g. `power_deadband`.
+"""
+SENSOR_CLASSES = ("temperature", "humidity", "power")
+CONF_DEADBAND = "deadband"
+CONF_DEADBAND_PERCENT = "deadband_percent"
+CONF_MIN_WRITE_INTERVAL = "min_write_interval"
+CONF_HEARTBEAT = "heartbeat"
+DEFAULT_STATE_WRITES = {
+    "temperature": {
+        CONF_DEADBAND: 0.0,
+        CONF_DEADBAND_PERCENT: 0.0,
+        CONF_MIN_WRITE_INTERVAL: 0,
+        CONF_HEARTBEAT: 3600
+    },
+    "humidity": {
+        CONF_DEADBAND: 1.0,
+        CONF_DEADBAND_PERCENT: 0.0,
+        CONF_MIN_WRITE_INTERVAL: 0,
+        CONF_HEARTBEAT: 3600
+    },
+    "power": {
+        CONF_DEADBAND: 0.0,
+        CONF_DEADBAND_PERCENT: 5.0,
+        CONF_MIN_WRITE_INTERVAL: 60,
+        CONF_HEARTBEAT: 900
+    }
+}
+
+"""
+High resolution power mode. The power of meter nodes is fetched as a series with
+POWER_SAMPLE_PERIOD between the samples, instead of only the latest value.
+The series of the last POWER_HISTORY_WINDOW is kept in a ring buffer, from which
+rolling aggregates over POWER_ROLLING_WINDOW and the peak hour of today are derived.
+"""
+CONF_POWER_HIGH_RESOLUTION = "power_high_resolution"
+DEFAULT_POWER_HIGH_RESOLUTION = False
+POWER_SAMPLE_PERIOD = timedelta(minutes=1)
+POWER_HISTORY_WINDOW = timedelta(hours=24)
+POWER_ROLLING_WINDOW = timedelta(hours=1)
+
+"""
+Every measurement fetched for a node is kept in a ring buffer of MEASUREMENT_HISTORY_SIZE
+samples, about a day of reports. Sensors are derived from rolling windows of the history,
+the rate of change of the temperature, the temperature range and the humidity trend.
+"""
+MEASUREMENT_HISTORY_SIZE = 320
+TEMPERATURE_RATE_WINDOW = timedelta(hours=1)
+TEMPERATURE_RANGE_WINDOW = timedelta(hours=24)
+HUMIDITY_TREND_WINDOW = timedelta(hours=3)
+
+"""
+Reports missed while Home Assistant or the API was down are fetched into the history
+with a single query per measurement type, with CATCH_UP_SAMPLE_PERIOD between the samples.
+A gap is more than CATCH_UP_MISSED_REPORTS report intervals since the latest sample,
+and no more than CATCH_UP_WINDOW is fetched.
+"""
+CATCH_UP_MISSED_REPORTS = 2
+CATCH_UP_SAMPLE_PERIOD = timedelta(minutes=5)
+CATCH_UP_WINDOW = timedelta(hours=24)
+
+"""
+Time to wait after a day has ended before its energy is frozen in the ledger,
+this allows late measurements to be reported.
+"""
+ENERGY_SETTLE_TIME = timedelta(hours=2)
+
+"""
+How long days are kept in the energy ledger.
+"""
+ENERGY_LEDGER_RETENTION = timedelta(days=400)
+
+"""
+Measurements are imported to long-term statistics in chunks of this many days,
+so a long range never has to be held in memory at once.
+"""
+STATISTICS_CHUNK_DAYS = 7
+
+"""
+Period of the samples used to calculate hourly mean, min and max.
+"""
+STATISTICS_SAMPLE_PERIOD = "PT15M"
+
+"""
+The API is considered unavailable after this many consecutive failed requests,
+counting only transport, authentication and server errors, and only once
+requests to at least CIRCUIT_FAILING_ENDPOINTS different endpoints are failing.
+While unavailable, a single request probes the API with exponential backoff.
+"""
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_FAILING_ENDPOINTS = 2
+CIRCUIT_PROBE_DELAY = timedelta(seconds=30)
+CIRCUIT_MAX_PROBE_DELAY = timedelta(minutes=30)
+
+"""
+How often the diagnostic sensors of the API request statistics write their state.
+The statistics change with almost every request, so they are not written on every change.
+"""
+API_STATS_INTERVAL = timedelta(minutes=15)
+
+"""
+Requests to the API, from all accounts, are limited to this many requests per second.
+A burst of up to REQUEST_RATE_BURST requests is made without waiting.
+"""
+REQUEST_RATE_LIMIT = 5
+REQUEST_RATE_BURST = 20
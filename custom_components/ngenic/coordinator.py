@@ -0,0 +1,394 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from homeassistant.core import CoreState, callback
+from homeassistant.helpers.start import async_at_started
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    SCAN_INTERVAL,
+    REPORT_POLL_DELAY,
+    MEASUREMENT_HISTORY_SIZE,
+    CATCH_UP_MISSED_REPORTS,
+    CATCH_UP_SAMPLE_PERIOD,
+    CATCH_UP_WINDOW
+)
+from .errors import ApiUnavailable
+from .measurement import get_from_to_time, get_period
+from .scheduler import NgenicReportSchedule, next_staggered
+
+_LOGGER = logging.getLogger(__name__)
+
+# shortest time between two refreshes
+MIN_REFRESH_INTERVAL = timedelta(seconds=10)
+
+# refreshes may be scheduled slightly early, a measurement due within this time is fetched
+DUE_TOLERANCE = timedelta(seconds=2)
+
+# a failed measurement is retried after this delay, doubled after every failure in a row
+RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(minutes=30)
+
+class NgenicNodeCoordinator(DataUpdateCoordinator):
+    """Coordinate measurement fetches for a single Ngenic node.
+
+    Entities register the measurement they display together with how often
+    it should be refreshed. Each refresh cycle fetches every registered
+    measurement that is due and fans the results out to all entities of the node,
+    so timers and API calls scale with the number of nodes rather than entities.
+
+    Measurements registered without an update interval are reported by the
+    node itself, these are polled shortly after the node is expected to
+    report according to its `NgenicReportSchedule`. Measurements with an update
+    interval are fetched at a fixed offset within their interval, derived from
+    their key, so measurements of different nodes are not all fetched at once.
+    A measurement that fails is retried with exponential backoff.
+
+    Reported measurements are kept in a ring buffer per measurement type,
+    from which sensors are derived without any further requests. The buffers
+    and the report schedule are kept in the `NgenicMeasurementStore` of the
+    config entry, so after a restart a measurement that is still current is
+    not fetched again until the node reports.
+
+    While the API is unavailable no measurements are fetched and all entities
+    of the node are unavailable. Once the API has recovered every measurement
+    that has become due meanwhile is fetched in a single refresh. The first
+    fetch of a reported measurement after startup or an outage fills any gap
+    in its history with a single ranged query, instead of only fetching the
+    latest value.
+
+    Measurements registered as deferred are not fetched before Home Assistant
+    has started, so slow queries don't delay measurements that are shown at once.
+    """
+
+    def __init__(self, hass, api, node, name, store):
+        super().__init__(
+            hass,
+            _LOGGER,
+            name=name,
+            update_interval=SCAN_INTERVAL
+        )
+        self._api = api
+        self._node = node
+        self._store = store
+        self._schedule = NgenicReportSchedule(name)
+        store.restore_schedule(node.uuid(), self._schedule)
+        self._next_report_poll = None
+
+        # key -> (update interval or None, coroutine function returning the new value)
+        self._fetchers = {}
+        self._last_fetched = {}
+        self._failed = set()
+
+        # key -> when a failed measurement is retried, and the delay before that retry
+        self._retry_at = {}
+        self._retry_delay = {}
+
+        # keys that are not fetched before Home Assistant has started
+        self._deferred = set()
+
+        # keys of measurements missing from the topology, which are not fetched until they reappear
+        self._paused = set()
+
+        # measurement type -> NgenicRingBuffer
+        self._history = {}
+
+        # measurement types checked for gaps since startup or the latest outage
+        self._caught_up = set()
+
+        self._remove_api_listener = api.async_add_listener(self._async_api_availability_changed)
+
+    @property
+    def node(self):
+        return self._node
+
+    def async_add_fetcher(self, key, update_interval, fetch, restore=None, deferred=False):
+        """Register a measurement that should be fetched every update interval.
+        If update interval is None, the measurement is fetched when the node reports.
+        `restore` may return the stored measurement as a tuple of value and timestamp,
+        which is used until the measurement is fetched.
+        A deferred measurement is first fetched once Home Assistant has started.
+        """
+        self._fetchers[key] = (update_interval, fetch)
+        restored = restore() if restore is not None else None
+        if restored is not None:
+            self.restore(key, *restored)
+
+        if deferred and self.hass.state is not CoreState.running:
+            if not self._deferred:
+                async_at_started(self.hass, self._async_started)
+            self._deferred.add(key)
+
+        self.update_interval = self._next_refresh_interval(dt_util.utcnow())
+
+    @callback
+    def async_remove_fetcher(self, key):
+        """Stop fetching a measurement, e.g. when the node no longer has it"""
+        self._fetchers.pop(key, None)
+        self._last_fetched.pop(key, None)
+        self._failed.discard(key)
+        self._retry_at.pop(key, None)
+        self._retry_delay.pop(key, None)
+        self._deferred.discard(key)
+        self._paused.discard(key)
+        if self.data is not None:
+            self.data.pop(key, None)
+
+    @callback
+    def async_pause_fetcher(self, key):
+        """Stop fetching a measurement that is missing from the topology, and make its entity unavailable.
+        The measurement keeps its data, so it can resume if it reappears.
+        """
+        if key in self._fetchers and key not in self._paused:
+            self._paused.add(key)
+            self.async_update_listeners()
+
+    @callback
+    def async_resume_fetcher(self, key):
+        """Fetch a paused measurement again at once"""
+        if key in self._paused:
+            self._paused.discard(key)
+            self._last_fetched.pop(key, None)
+            self.hass.async_create_task(self.async_request_refresh())
+
+    async def async_shutdown(self):
+        """Stop refreshing and following the API, e.g. when the node has been removed"""
+        await super().async_shutdown()
+        if self._remove_api_listener is not None:
+            self._remove_api_listener()
+            self._remove_api_listener = None
+
+    def has_data(self, key):
+        """Return if a value of a measurement has been fetched or restored"""
+        return self.data is not None and key in self.data
+
+    def restore(self, key, value, timestamp):
+        """Use a stored measurement as if it was fetched when it was measured.
+        It is fetched in the first refresh if a newer measurement should exist by now.
+        """
+        self.data = {**(self.data or {}), key: value}
+
+        now = dt_util.utcnow()
+        measured_at = dt_util.utc_from_timestamp(timestamp)
+        interval = self._fetchers[key][0]
+        if interval is None:
+            if measured_at + self._schedule.interval + REPORT_POLL_DELAY <= now:
+                return
+            self._next_report_poll = self._schedule.next_poll(now)
+        elif measured_at + interval <= now:
+            return
+        self._last_fetched[key] = measured_at
+
+    def history(self, measurement_type, capacity=MEASUREMENT_HISTORY_SIZE):
+        """Get the history of a measurement type reported by the node.
+        The history is created with `capacity` samples on first use.
+        """
+        if measurement_type not in self._history:
+            self._history[measurement_type] = self._store.history(self._node.uuid(), measurement_type, capacity)
+        return self._history[measurement_type]
+
+    def is_available(self, key):
+        """Return if the latest fetch of a measurement succeeded"""
+        return (
+            self.last_update_success
+            and self.has_data(key)
+            and key not in self._failed
+            and key not in self._paused
+        )
+
+    async def async_latest_measurement(self, measurement_type):
+        """Fetch the latest measurement of a type reported by the node.
+        The time of the measurement is used to learn when the node reports.
+        Return the measurement value, or 0 if the node hasn't reported any measurement.
+        """
+        if measurement_type not in self._caught_up:
+            self._caught_up.add(measurement_type)
+            if self._has_gap(measurement_type):
+                return await self._async_catch_up(measurement_type)
+
+        measurement = await self._api.async_measurement(self._node, measurement_type)
+        if not measurement:
+            _LOGGER.info("Measurement not found (type=%s, name=%s)" % (measurement_type, self.name))
+            return 0
+
+        measured_at = dt_util.parse_datetime(measurement["time"])
+        self._schedule.record(measured_at)
+        self.history(measurement_type).append(measured_at.timestamp(), measurement["value"])
+        return measurement["value"]
+
+    async def async_measurement_series(self, measurement_type, window, period):
+        """Fetch the measurements of a type reported since the latest sample in its history,
+        but no more than `window` back, and append them to the history.
+        The latest sample is fetched again as its period might not have ended when it was fetched.
+        The time of the latest sample is used to learn when the node reports.
+        Return the latest value in the history, or 0 if the node hasn't reported any measurement.
+        """
+        buffer = self.history(measurement_type)
+        now = dt_util.utcnow()
+        start = (now - window).timestamp()
+        if buffer.latest_time is not None:
+            start = max(start, buffer.latest_time)
+
+        # samples start at whole periods
+        seconds = period.total_seconds()
+        from_dt, to_dt = get_from_to_time(dt_util.utc_from_timestamp(start // seconds * seconds), now)
+
+        measurements = await self._api.async_measurement(
+            self._node,
+            measurement_type,
+            from_dt=from_dt,
+            to_dt=to_dt,
+            period=get_period(period),
+            cache=False
+        )
+        if measurements and not isinstance(measurements, list):
+            measurements = [measurements]
+        for measurement in measurements or []:
+            if measurement["value"] is not None:
+                buffer.append(dt_util.parse_datetime(measurement["time"]).timestamp(), measurement["value"])
+
+        if buffer.latest_time is None:
+            _LOGGER.info("Measurement not found (type=%s, name=%s)" % (measurement_type, self.name))
+            return 0
+
+        self._schedule.record(dt_util.utc_from_timestamp(buffer.latest_time))
+        return buffer.latest_value
+
+    def _has_gap(self, measurement_type):
+        """Return if the node has reported measurements that are missing in the history"""
+        latest = self.history(measurement_type).latest_time
+        if latest is None:
+            return False
+        missed = self._schedule.interval * CATCH_UP_MISSED_REPORTS
+        return dt_util.utc_from_timestamp(latest) + missed < dt_util.utcnow()
+
+    async def _async_catch_up(self, measurement_type):
+        """Fetch all measurements since the latest sample in the history with a single query"""
+        latest = dt_util.utc_from_timestamp(self.history(measurement_type).latest_time)
+        _LOGGER.info("Catching up on measurements since %s (type=%s, name=%s)" % (latest, measurement_type, self.name))
+        return await self.async_measurement_series(measurement_type, CATCH_UP_WINDOW, CATCH_UP_SAMPLE_PERIOD)
+
+    async def _async_started(self, hass):
+        """Fetch the deferred measurements now that Home Assistant has started"""
+        self._deferred = set()
+        if self._listeners:
+            # the entities of the node have not been removed before Home Assistant started
+            await self.async_refresh()
+
+    @callback
+    def _async_api_availability_changed(self, available):
+        """Mark all entities unavailable at once, or refresh them all once the API has recovered"""
+        if available:
+            # measurements that were due during the outage are fetched now,
+            # and reported measurements are checked for reports missed meanwhile
+            self._caught_up = set()
+            self._retry_at = {}
+            self.hass.async_create_task(self.async_refresh())
+            return
+
+        # the API has already logged that it is unavailable, so don't use async_set_update_error
+        self.last_exception = ApiUnavailable("Ngenic API is unavailable")
+        if self.last_update_success:
+            self.last_update_success = False
+            self.async_update_listeners()
+
+    def _is_due(self, key, now):
+        """Return if a measurement should be fetched in this cycle"""
+        if key in self._deferred or key in self._paused:
+            return False
+        if key in self._failed:
+            return key not in self._retry_at or now + DUE_TOLERANCE >= self._retry_at[key]
+        if key not in self._last_fetched:
+            return True
+
+        interval = self._fetchers[key][0]
+        if interval is None:
+            return self._next_report_poll is None or now + DUE_TOLERANCE >= self._next_report_poll
+        return now + DUE_TOLERANCE >= self._next_fetch(key, interval)
+
+    def _schedule_retry(self, key, now):
+        """Retry a failed measurement after a delay that doubles with every failure in a row"""
+        delay = self._retry_delay.get(key)
+        delay = RETRY_DELAY if delay is None else min(delay * 2, MAX_RETRY_DELAY)
+        self._retry_delay[key] = delay
+        self._retry_at[key] = now + delay
+
+    def _next_fetch(self, key, interval):
+        """Get when a measurement with an update interval should be fetched next.
+        This is at the offset of the measurement within its interval, but never
+        sooner than half an interval after it was fetched.
+        """
+        return next_staggered(key, interval, self._last_fetched[key] + interval / 2)
+
+    def _next_refresh_interval(self, now):
+        """Get the time until the next measurement is due"""
+        next_refresh = []
+        for key, (interval, _) in self._fetchers.items():
+            if key in self._deferred or key in self._paused:
+                continue
+            if key in self._retry_at:
+                next_refresh.append(self._retry_at[key])
+            elif key not in self._last_fetched:
+                continue
+            elif interval is None:
+                next_refresh.append(self._next_report_poll)
+            else:
+                next_refresh.append(self._next_fetch(key, interval))
+
+        if not next_refresh:
+            return SCAN_INTERVAL
+        return max(min(next_refresh) - now, MIN_REFRESH_INTERVAL)
+
+    async def _async_update_data(self):
+        """Fetch all measurements that are due for this node.
+        A failing measurement does not fail the whole refresh, instead
+        it is marked as failed and its entity becomes unavailable.
+        """
+        if not self._api.available:
+            raise UpdateFailed("Ngenic API is unavailable")
+
+        now = dt_util.utcnow()
+        data = dict(self.data or {})
+        due = [key for key in self._fetchers if self._is_due(key, now)]
+
+        results = await asyncio.gather(
+            *[self._fetchers[key][1]() for key in due],
+            return_exceptions=True
+        )
+
+        if not self._api.available:
+            # the API became unavailable during the refresh
+            raise UpdateFailed("Ngenic API is unavailable")
+
+        for key, result in zip(due, results):
+            if isinstance(result, Exception):
+                # Don't throw an exception if a measurement fails to update.
+                # Instead, make the entity unavailable.
+                if key not in self._failed:
+                    _LOGGER.warning("Failed to update sensor '%s', it is unavailable until it has recovered: %s", key, result)
+                _LOGGER.debug("Failed to update sensor '%s'", key, exc_info=result)
+                self._failed.add(key)
+                self._schedule_retry(key, now)
+                continue
+            if isinstance(result, BaseException):
+                raise result
+
+            data[key] = result
+            if key in self._failed:
+                _LOGGER.warning("Sensor '%s' has recovered", key)
+                self._failed.discard(key)
+            self._retry_at.pop(key, None)
+            self._retry_delay.pop(key, None)
+            self._last_fetched[key] = now
+
+        if any(self._fetchers[key][0] is None for key in due):
+            self._schedule.poll_completed()
+            self._next_report_poll = self._schedule.next_poll(dt_util.utcnow())
+            self._store.async_schedule_save()
+
+        # schedule the next refresh when the next measurement is due
+        self.update_interval = self._next_refresh_interval(dt_util.utcnow())
+
+        return data
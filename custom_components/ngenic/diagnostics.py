@@ -0,0 +1,40 @@
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.const import CONF_TOKEN
+
+from .const import (
+    DOMAIN,
+    DATA_API,
+    DATA_TOPOLOGY
+)
+
+TO_REDACT = {CONF_TOKEN}
+
+async def async_get_config_entry_diagnostics(hass, config_entry):
+    """Return diagnostics for a config entry.
+    This contains the request statistics of the API and a summary of the topology.
+    """
+    entry_data = hass.data[DOMAIN][config_entry.entry_id]
+    api = entry_data[DATA_API]
+    topology = entry_data[DATA_TOPOLOGY]
+
+    return {
+        "entry": async_redact_data(config_entry.as_dict(), TO_REDACT),
+        "api": dict(api.stats.as_dict(), available=api.available),
+        "topology": [
+            {
+                "tune": tune.tune.uuid(),
+                "rooms": len(tune.rooms),
+                "nodes": [
+                    {
+                        "uuid": node.uuid(),
+                        "type": node.get_type().name,
+                        "measurement_types": [
+                            measurement_type.value for measurement_type in topology.measurement_types(node)
+                        ]
+                    }
+                    for node in tune.nodes
+                ]
+            }
+            for tune in topology.tunes
+        ]
+    }
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from ngenicpy.models.measurement import MeasurementType
+
+from homeassistant.helpers.storage import Store
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    DOMAIN,
+    STORAGE_VERSION,
+    ENERGY_LEDGER_RETENTION,
+    ENERGY_SETTLE_TIME
+)
+from .measurement import (
+    get_from_to_date,
+    get_measurement_date
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# time to wait before saving the ledger after it has been changed
+SAVE_DELAY = 60
+
+# calendar periods the ledger can answer
+PERIOD_TODAY = "today"
+PERIOD_WEEK = "week"
+PERIOD_MONTH = "month"
+PERIOD_LAST_MONTH = "last_month"
+PERIOD_YEAR = "year"
+PERIOD_ROLLING_30_DAYS = "rolling_30_days"
+PERIODS = (PERIOD_TODAY, PERIOD_WEEK, PERIOD_MONTH, PERIOD_LAST_MONTH, PERIOD_YEAR, PERIOD_ROLLING_30_DAYS)
+
+def get_period_dates(period, today):
+    """Get the local dates of a period that ends today, or that ended before today.
+    Return a tuple of the first date (inclusive) and the last date (exclusive).
+
+    Periods are counted in local dates, so a period that spans a change of
+    daylight saving time still starts and ends at local midnight.
+    """
+    tomorrow = today + timedelta(days=1)
+    if period == PERIOD_TODAY:
+        return today, tomorrow
+    if period == PERIOD_WEEK:
+        return today - timedelta(days=today.weekday()), tomorrow
+    if period == PERIOD_MONTH:
+        return today.replace(day=1), tomorrow
+    if period == PERIOD_LAST_MONTH:
+        this_month = today.replace(day=1)
+        return (this_month - timedelta(days=1)).replace(day=1), this_month
+    if period == PERIOD_YEAR:
+        return today.replace(month=1, day=1), tomorrow
+    if period == PERIOD_ROLLING_30_DAYS:
+        return tomorrow - timedelta(days=30), tomorrow
+    raise ValueError("Unknown period %s" % period)
+
+class NgenicEnergyLedger:
+    """Local ledger of daily energy consumption per node.
+
+    Energy for a day never changes once the day is over and all late
+    measurements have been reported. Such days are frozen in the ledger,
+    which is persisted with the Home Assistant storage helper, so they
+    never have to be fetched again. Only the open day (today) and days
+    that have not settled yet are fetched from the API.
+
+    The API doesn't return days without energy. Days before the first day
+    a node has energy for count as 0 and are never fetched again, nor are
+    settled days without energy followed by a settled day with energy.
+    Only days without energy after the last settled day with energy are
+    fetched again with the open days, as their energy might just be late.
+
+    Every period (today, this week, this month, last month, this year and
+    the last 30 days) is the sum of its days in the ledger. When a day of a
+    period has to be fetched, the days of all periods that have to be fetched
+    are fetched with it. Open days are shared by all periods, so a period
+    doesn't make a request if the open days were fetched recently enough
+    for another period.
+    """
+
+    def __init__(self, hass, api, entry_id):
+        self._hass = hass
+        self._api = api
+        self._store = Store(hass, STORAGE_VERSION, "%s.%s.energy" % (DOMAIN, entry_id))
+
+        # node uuid -> {iso date -> kWh} of frozen days
+        self._days = {}
+
+        # node uuid -> {date -> (kWh, time of fetch)} of days that are not frozen yet
+        self._open_days = {}
+
+        # node uuid -> iso date of the first day the node has energy for
+        self._first_days = {}
+
+        # node uuid -> lock, so concurrent periods of a node don't fetch the same days
+        self._locks = {}
+
+    async def async_load(self):
+        """Load frozen days from storage"""
+        stored = await self._store.async_load()
+        if stored is not None:
+            self._days = stored["days"]
+            self._first_days = stored.get("first_days", {})
+
+    async def async_period(self, node, period, max_age):
+        """Get the energy consumed by a node during a period.
+        Open days fetched longer than `max_age` ago are fetched again.
+        """
+        from_date, to_date = get_period_dates(period, dt_util.now().date())
+        days = await self._async_days(node, from_date, to_date, max_age)
+        return sum(days.values())
+
+    async def _async_days(self, node, from_date, to_date, max_age):
+        """Get the energy of all days from `from_date` (inclusive) to `to_date` (exclusive).
+        Days missing in the ledger, and open days older than `max_age`, are fetched
+        with a single query, together with the missing days of all other periods.
+        Return a dict with date as key and kWh as value.
+        """
+        lock = self._locks.setdefault(node.uuid(), asyncio.Lock())
+        async with lock:
+            frozen = self._days.setdefault(node.uuid(), {})
+            open_days = self._open_days.setdefault(node.uuid(), {})
+            now = dt_util.utcnow()
+
+            def is_missing(date):
+                return (
+                    date.isoformat() not in frozen
+                    and not self._before_first_day(node, date)
+                    and (date not in open_days or now - open_days[date][1] > max_age)
+                )
+
+            dates = [from_date + timedelta(days=i) for i in range((to_date - from_date).days)]
+            if any(is_missing(date) for date in dates):
+                # the first day of any period to the last day of this period
+                today = dt_util.now().date()
+                first = min(min(get_period_dates(period, today)[0] for period in PERIODS), from_date)
+                missing = [
+                    date for date in (first + timedelta(days=i) for i in range((to_date - first).days))
+                    if is_missing(date)
+                ]
+                fetched = await self._async_fetch_days(node, missing[0], missing[-1] + timedelta(days=1))
+
+                self._store_days(node, {date: fetched[date] for date in missing if date in fetched}, now)
+                self._store_days_without_energy(node, [date for date in missing if date not in fetched], fetched, now)
+
+            return {
+                date: (
+                    frozen[date.isoformat()] if date.isoformat() in frozen
+                    else 0 if self._before_first_day(node, date)
+                    else open_days[date][0]
+                )
+                for date in dates
+            }
+
+    async def _async_fetch_days(self, node, from_date, to_date):
+        """Fetch the daily energy for a range of days"""
+        from_dt, to_dt = get_from_to_date(from_date, to_date)
+        _LOGGER.debug("Fetch daily energy (node=%s, from=%s, to=%s)" % (node.uuid(), from_dt, to_dt))
+        measurements = await self._api.async_measurement(
+            node,
+            MeasurementType.ENERGY_KWH,
+            from_dt=from_dt,
+            to_dt=to_dt,
+            period="P1D"
+        )
+        if not measurements:
+            # measurement API will return None if no measurements were found for the period
+            return {}
+        if not isinstance(measurements, list):
+            measurements = [measurements]
+
+        return {get_measurement_date(measurement): measurement["value"] for measurement in measurements}
+
+    def _before_first_day(self, node, date):
+        """Return if a day is before the first day the node has energy for"""
+        first_day = self._first_days.get(node.uuid())
+        return first_day is not None and date.isoformat() < first_day
+
+    def _store_days_without_energy(self, node, days, fetched, fetched_at):
+        """Handle days the API has not returned any energy for.
+        The first time energy is fetched for a node, the days before the first day it
+        has energy for, or before the first day that hasn't settled, mark where its
+        energy starts. Settled days before a settled day with energy are frozen as 0.
+        Other days are kept as open days with 0, so they are fetched again.
+        """
+        now = dt_util.now()
+        frozen = self._days[node.uuid()]
+        settled = [date for date in fetched if self._is_settled(date, now)]
+        settled.extend(dt_util.parse_date(date) for date in frozen)
+        last_settled = max(settled, default=None)
+
+        if node.uuid() not in self._first_days:
+            first_day = min(
+                list(fetched) + [date for date in days if not self._is_settled(date, now)],
+                default=None
+            )
+            if first_day is not None:
+                _LOGGER.debug("First day with energy (node=%s, date=%s)" % (node.uuid(), first_day))
+                self._first_days[node.uuid()] = first_day.isoformat()
+                self._store.async_delay_save(self._data_to_save, SAVE_DELAY)
+
+        zeros = {}
+        for date in days:
+            if self._before_first_day(node, date):
+                continue
+            if last_settled is not None and date < last_settled and self._is_settled(date, now):
+                zeros[date] = 0
+            else:
+                self._open_days[node.uuid()][date] = (0, fetched_at)
+        if zeros:
+            self._store_days(node, zeros, fetched_at)
+
+    def _is_settled(self, date, now):
+        """Return if all late measurements of a day have been reported"""
+        return now >= dt_util.start_of_local_day(date + timedelta(days=1)) + ENERGY_SETTLE_TIME
+
+    def _store_days(self, node, days, fetched_at):
+        """Freeze the days that have settled in the ledger, keep the others as open days"""
+        now = dt_util.now()
+        frozen = self._days[node.uuid()]
+        open_days = self._open_days[node.uuid()]
+        changed = False
+        for date, value in days.items():
+            if self._is_settled(date, now):
+                if date.isoformat() not in frozen:
+                    frozen[date.isoformat()] = value
+                    changed = True
+                open_days.pop(date, None)
+            else:
+                open_days[date] = (value, fetched_at)
+
+        # forget days that are too old to be used for any period
+        oldest = now.date() - ENERGY_LEDGER_RETENTION
+        for date in [date for date in frozen if date < oldest.isoformat()]:
+            del frozen[date]
+            changed = True
+        for date in [date for date in open_days if date < oldest]:
+            del open_days[date]
+
+        if changed:
+            self._store.async_delay_save(self._data_to_save, SAVE_DELAY)
+
+    def _data_to_save(self):
+        return {
+            "days": self._days,
+            "first_days": self._first_days
+        }
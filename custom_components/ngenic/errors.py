@@ -10,4 +10,7 @@ class AlreadyConfigured(NgenicException):
     """Device is already configured."""
 
 class NoTunes(NgenicException):
-    """No tunes."""
\ No newline at end of file
+    """No tunes."""
+
+class ApiUnavailable(NgenicException):
+    """The Ngenic API is unavailable, requests are not made until it has recovered."""
\ No newline at end of file
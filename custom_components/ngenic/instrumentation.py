@@ -0,0 +1,98 @@
+import time
+
+# the endpoints of the Ngenic API used by the integration
+ENDPOINTS = (
+    "tunes",
+    "tune",
+    "rooms",
+    "room",
+    "nodes",
+    "measurement_types",
+    "measurement_latest",
+    "measurements",
+    "update_room"
+)
+
+# upper bounds (seconds) of the latency histogram buckets, a last bucket holds anything slower
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class NgenicEndpointStats:
+    """Request counters and a latency histogram of a single endpoint"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.last_error = None
+
+    @property
+    def average_latency(self):
+        """Return the average latency in seconds, or None if no requests have been made"""
+        if not self.requests:
+            return None
+        return self.total_latency / self.requests
+
+    def record(self, latency, error=None):
+        """Record a request that took `latency` seconds"""
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.buckets[bucket] += 1
+
+        if error is not None:
+            self.errors += 1
+            self.last_error = "%s: %s" % (error.__class__.__name__, error)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "average_latency": self.average_latency,
+            "max_latency": self.max_latency,
+            "latency_histogram": {
+                ("<=%gs" % bound if i < len(LATENCY_BUCKETS) else ">%gs" % LATENCY_BUCKETS[-1]): count
+                for i, (bound, count) in enumerate(zip(LATENCY_BUCKETS + (None,), self.buckets))
+            },
+            "last_error": self.last_error
+        }
+
+class NgenicApiStats:
+    """Statistics of all requests made to the Ngenic API.
+
+    Only requests that reach the API are counted per endpoint,
+    results served from the cache or from a request in flight are
+    counted separately.
+    """
+
+    def __init__(self):
+        self.endpoints = {endpoint: NgenicEndpointStats() for endpoint in ENDPOINTS}
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.started = time.time()
+
+    @property
+    def requests(self):
+        return sum(stats.requests for stats in self.endpoints.values())
+
+    @property
+    def errors(self):
+        return sum(stats.errors for stats in self.endpoints.values())
+
+    def record(self, endpoint, latency, error=None):
+        self.endpoints.setdefault(endpoint, NgenicEndpointStats()).record(latency, error)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "uptime": time.time() - self.started,
+            "endpoints": {endpoint: stats.as_dict() for endpoint, stats in self.endpoints.items()}
+        }
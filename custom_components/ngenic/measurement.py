@@ -0,0 +1,41 @@
+from datetime import datetime, time
+
+import homeassistant.util.dt as dt_util
+
+def get_time_zone():
+    """Get the name of the time zone of Home Assistant, or `Z` in case of UTC.
+    It is read on every call, as the time zone can be changed while running.
+    """
+    return "Z" if str(dt_util.DEFAULT_TIME_ZONE) == "UTC" else str(dt_util.DEFAULT_TIME_ZONE)
+
+def get_from_to_date(from_date, to_date):
+    """Get a period between two dates
+    This will return two dates in ISO 8601:2004 format
+    The first date will be at 00:00 on `from_date`, and the second
+    date will be at 00:00 on `to_date`.
+
+    Both dates include the time zone name, or `Z` in case of UTC.
+
+    When asking for measurements, the `from` datetime is inclusive
+    and the `to` datetime is exclusive.
+    """
+    time_zone = get_time_zone()
+    return (datetime.combine(from_date, time.min).isoformat() + " " + time_zone,
+            datetime.combine(to_date, time.min).isoformat() + " " + time_zone)
+
+def get_from_to_time(from_time, to_time):
+    """Get a period between two points in time
+    This will return two datetimes in ISO 8601:2004 format, in
+    local time followed by the time zone name, or `Z` in case of UTC.
+    """
+    time_zone = get_time_zone()
+    return (dt_util.as_local(from_time).replace(tzinfo=None, microsecond=0).isoformat() + " " + time_zone,
+            dt_util.as_local(to_time).replace(tzinfo=None, microsecond=0).isoformat() + " " + time_zone)
+
+def get_period(duration):
+    """Format a duration of whole minutes as an ISO 8601:2004 period, e.g. `PT15M`"""
+    return "PT%dM" % (duration.total_seconds() // 60)
+
+def get_measurement_date(measurement):
+    """Get the local date a measurement was made"""
+    return dt_util.as_local(dt_util.parse_datetime(measurement["time"])).date()
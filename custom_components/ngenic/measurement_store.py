@@ -0,0 +1,116 @@
+import logging
+
+from homeassistant.core import callback
+from homeassistant.helpers.storage import Store
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    DOMAIN,
+    STORAGE_VERSION
+)
+from .ringbuffer import NgenicRingBuffer
+
+_LOGGER = logging.getLogger(__name__)
+
+# time to wait before saving the measurements after new samples have arrived,
+# every save writes all buffers so samples of many reports are saved together.
+# pending samples are saved when the entry is unloaded or Home Assistant stops
+SAVE_DELAY = 15 * 60
+
+class NgenicMeasurementStore:
+    """Local store of the measurement history of all nodes of a config entry.
+
+    The ring buffers and report schedules of the node coordinators are saved
+    with the Home Assistant storage helper some time after new samples have arrived,
+    and when the entry is unloaded, keyed by node, measurement type and timestamp. After a restart the buffers
+    and schedules continue from the stored samples, so sensors have a value
+    before anything is fetched and series are only fetched from their latest sample.
+    """
+
+    def __init__(self, hass, entry_id):
+        self._store = Store(hass, STORAGE_VERSION, "%s.%s.measurements" % (DOMAIN, entry_id))
+
+        # node uuid -> {"reports": [timestamps], "history": {measurement type -> {"t": [timestamps], "v": [values]}}}
+        self._stored = {}
+
+        # node uuid -> {measurement type -> NgenicRingBuffer} and node uuid -> NgenicReportSchedule
+        self._buffers = {}
+        self._schedules = {}
+        self._save_pending = False
+
+    async def async_load(self):
+        """Load the stored measurements"""
+        stored = await self._store.async_load()
+        if stored is not None:
+            self._stored = stored["nodes"]
+            _LOGGER.debug("Loaded measurements of %d nodes from storage" % len(self._stored))
+
+    def history(self, node_uuid, measurement_type, capacity):
+        """Create the history of a measurement type of a node with the stored samples"""
+        buffer = NgenicRingBuffer(capacity)
+        stored = self._stored.get(node_uuid, {}).get("history", {}).pop(measurement_type.value, None)
+        if stored is not None:
+            for timestamp, value in zip(stored["t"], stored["v"]):
+                buffer.append(timestamp, value)
+
+        self._buffers.setdefault(node_uuid, {})[measurement_type.value] = buffer
+        return buffer
+
+    def restore_schedule(self, node_uuid, schedule):
+        """Continue the report schedule of a node from the stored report times"""
+        reports = self._stored.get(node_uuid, {}).pop("reports", [])
+        schedule.restore([dt_util.utc_from_timestamp(timestamp) for timestamp in reports])
+        self._schedules[node_uuid] = schedule
+
+    @callback
+    def async_prune(self, node_uuids):
+        """Forget the measurements of all nodes that are not in `node_uuids`, e.g. removed nodes"""
+        removed = (self._stored.keys() | self._buffers.keys() | self._schedules.keys()) - set(node_uuids)
+        for node_uuid in removed:
+            self._stored.pop(node_uuid, None)
+            self._buffers.pop(node_uuid, None)
+            self._schedules.pop(node_uuid, None)
+
+        if removed:
+            _LOGGER.debug("Removed measurements of %d nodes" % len(removed))
+            self.async_schedule_save()
+
+    async def async_save(self):
+        """Save all nodes now, e.g. when the entry is unloaded"""
+        await self._store.async_save(self._data_to_save())
+
+    @callback
+    def async_schedule_save(self):
+        """Save all nodes after a short delay, so the samples of many refreshes are saved together.
+        The delay is not restarted by later samples, as refreshes of many nodes could postpone the save forever.
+        """
+        if not self._save_pending:
+            self._save_pending = True
+            self._store.async_delay_save(self._data_to_save, SAVE_DELAY)
+
+    def _data_to_save(self):
+        self._save_pending = False
+        nodes = {}
+        for node_uuid, schedule in self._schedules.items():
+            nodes.setdefault(node_uuid, {})["reports"] = [
+                measured_at.timestamp() for measured_at in schedule.reports
+            ]
+
+        for node_uuid, buffers in self._buffers.items():
+            history = nodes.setdefault(node_uuid, {}).setdefault("history", {})
+            for measurement_type, buffer in buffers.items():
+                samples = list(buffer.samples())
+                history[measurement_type] = {
+                    "t": [timestamp for timestamp, _ in samples],
+                    "v": [value for _, value in samples]
+                }
+
+        # keep whatever has not been restored yet, e.g. nodes that failed to set up
+        for node_uuid, stored in self._stored.items():
+            node = nodes.setdefault(node_uuid, {})
+            if "reports" in stored:
+                node.setdefault("reports", stored["reports"])
+            for measurement_type, samples in stored.get("history", {}).items():
+                node.setdefault("history", {}).setdefault(measurement_type, samples)
+
+        return {"nodes": nodes}
@@ -0,0 +1,201 @@
+from array import array
+from collections import deque
+
+class NgenicRingBuffer:
+    """A fixed size series of timestamped measurement values.
+
+    Timestamps (seconds since the epoch) and values are kept in two arrays of
+    doubles, so a day of samples costs a few kilobytes per node. When the
+    buffer is full the oldest sample is overwritten.
+
+    Every sample gets a sequence number, counted from the first sample ever
+    appended. `NgenicRollingWindow` uses these to follow the samples of the
+    buffer as they arrive.
+    """
+
+    def __init__(self, capacity):
+        self._times = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+        self._capacity = capacity
+        self._count = 0
+        self._size = 0
+        self._windows = []
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def first_seq(self):
+        """Return the sequence number of the oldest sample in the buffer"""
+        return self._count - self._size
+
+    @property
+    def end_seq(self):
+        """Return the sequence number the next sample will get"""
+        return self._count
+
+    @property
+    def latest_time(self):
+        """Return the timestamp of the latest sample, or None if the buffer is empty"""
+        if not self._size:
+            return None
+        return self.time_at(self._count - 1)
+
+    @property
+    def latest_value(self):
+        """Return the value of the latest sample, or None if the buffer is empty"""
+        if not self._size:
+            return None
+        return self.value_at(self._count - 1)
+
+    def time_at(self, seq):
+        return self._times[seq % self._capacity]
+
+    def value_at(self, seq):
+        return self._values[seq % self._capacity]
+
+    def add_window(self, window):
+        self._windows.append(window)
+
+    def append(self, timestamp, value):
+        """Add a sample that is newer than every sample in the buffer.
+        A sample with the same timestamp as the latest sample replaces its value,
+        older samples are ignored.
+        """
+        latest = self.latest_time
+        if latest is not None and timestamp <= latest:
+            if timestamp == latest and value != self.latest_value:
+                self._values[(self._count - 1) % self._capacity] = value
+                for window in self._windows:
+                    window.replaced()
+            return
+
+        if self._size == self._capacity:
+            # the oldest sample is about to be overwritten
+            for window in self._windows:
+                window.discard(self._count - self._size)
+        else:
+            self._size += 1
+
+        i = self._count % self._capacity
+        self._times[i] = timestamp
+        self._values[i] = value
+        self._count += 1
+
+        for window in self._windows:
+            window.added(self._count - 1)
+
+    def samples(self, since=None):
+        """Yield (timestamp, value) of every sample, oldest first.
+        If `since` is set, only samples at or after that timestamp are yielded.
+        """
+        for seq in range(self.first_seq, self._count):
+            if since is None or self.time_at(seq) >= since:
+                yield self.time_at(seq), self.value_at(seq)
+
+    def values(self, since=None):
+        """Return a list of the values of all samples at or after `since`"""
+        return [value for _, value in self.samples(since)]
+
+class NgenicRollingWindow:
+    """Aggregates of the samples of a ring buffer within `window` of its latest sample.
+
+    The aggregates are kept up to date as samples are appended to the buffer,
+    without going through all samples of the window: a running sum for the mean,
+    and monotonic queues of sequence numbers for the min and max. If the buffer is
+    too small to hold the whole window, the window only covers the samples in the buffer.
+    """
+
+    def __init__(self, buffer, window):
+        self._buffer = buffer
+        self._window = window.total_seconds()
+        self._rebuild()
+        buffer.add_window(self)
+
+    @property
+    def count(self):
+        return self._buffer.end_seq - self._first
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self._sum / self.count
+
+    @property
+    def min(self):
+        if not self._min:
+            return None
+        return self._buffer.value_at(self._min[0])
+
+    @property
+    def max(self):
+        if not self._max:
+            return None
+        return self._buffer.value_at(self._max[0])
+
+    def rate(self, per):
+        """Get the change between the oldest and latest sample in the window per `per`,
+        or None if the window holds less than two samples.
+        """
+        if self.count < 2:
+            return None
+        first, last = self._first, self._buffer.end_seq - 1
+        elapsed = self._buffer.time_at(last) - self._buffer.time_at(first)
+        if elapsed <= 0:
+            return None
+        return (self._buffer.value_at(last) - self._buffer.value_at(first)) * per.total_seconds() / elapsed
+
+    def added(self, seq):
+        """Include a sample that was appended to the buffer"""
+        value = self._buffer.value_at(seq)
+        self._sum += value
+        while self._min and self._buffer.value_at(self._min[-1]) >= value:
+            self._min.pop()
+        self._min.append(seq)
+        while self._max and self._buffer.value_at(self._max[-1]) <= value:
+            self._max.pop()
+        self._max.append(seq)
+
+        # drop samples that are no longer within the window of the new sample
+        oldest = self._buffer.time_at(seq) - self._window
+        while self._first < seq and self._buffer.time_at(self._first) <= oldest:
+            self.discard(self._first)
+
+    def discard(self, seq):
+        """Drop the oldest sample of the window, if it is `seq`"""
+        if seq != self._first or self.count == 0:
+            return
+        self._sum -= self._buffer.value_at(seq)
+        if self._min and self._min[0] == seq:
+            self._min.popleft()
+        if self._max and self._max[0] == seq:
+            self._max.popleft()
+        self._first += 1
+
+    def replaced(self):
+        """The value of the latest sample was replaced, which the queues can't follow"""
+        self._rebuild()
+
+    def _rebuild(self):
+        """Aggregate the samples of the buffer that are within the window"""
+        self._sum = 0.0
+        self._min = deque()
+        self._max = deque()
+        self._first = self._buffer.end_seq
+
+        latest = self._buffer.latest_time
+        if latest is None:
+            return
+
+        first = self._buffer.first_seq
+        while self._buffer.time_at(first) <= latest - self._window:
+            first += 1
+
+        self._first = first
+        for seq in range(first, self._buffer.end_seq):
+            self.added(seq)
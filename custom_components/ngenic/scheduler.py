@@ -0,0 +1,135 @@
+import logging
+import math
+import zlib
+from datetime import timedelta
+from statistics import median
+
+from homeassistant.core import HassJob, callback
+from homeassistant.helpers.event import async_track_point_in_utc_time
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    SCAN_INTERVAL,
+    REPORT_POLL_DELAY,
+    REPORT_MIN_INTERVAL,
+    REPORT_MAX_BACKOFF
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+def stagger_offset(key, interval):
+    """Get a deterministic offset of `key` within `interval`.
+    The same key always gets the same offset, while different keys are
+    spread evenly over the interval.
+    """
+    return timedelta(seconds=zlib.crc32(key.encode()) % max(int(interval.total_seconds()), 1))
+
+def next_staggered(key, interval, after):
+    """Get the first time after `after` that is at the offset of `key` within `interval`.
+    Intervals are counted from the epoch, so the times don't depend on when Home Assistant started.
+    """
+    seconds = interval.total_seconds()
+    offset = stagger_offset(key, interval).total_seconds()
+    slot = math.floor((after.timestamp() - offset) / seconds) + 1
+    return dt_util.utc_from_timestamp(slot * seconds + offset)
+
+@callback
+def async_track_staggered_interval(hass, key, interval, action):
+    """Call `action` every `interval`, at the offset of `key` within the interval.
+    Return a function that stops the calls.
+    """
+    job = HassJob(action, "ngenic staggered interval %s" % key)
+    cancel = None
+
+    @callback
+    def _schedule(after):
+        nonlocal cancel
+        cancel = async_track_point_in_utc_time(hass, _run, next_staggered(key, interval, after))
+
+    @callback
+    def _run(now):
+        _schedule(now)
+        hass.async_run_hass_job(job, now)
+
+    @callback
+    def _cancel():
+        if cancel is not None:
+            cancel()
+
+    _schedule(dt_util.utcnow())
+    return _cancel
+
+# number of report intervals used to estimate how often a node reports
+REPORT_HISTORY = 8
+
+class NgenicReportSchedule:
+    """Learn when a node reports measurements and when to poll for them.
+
+    Nodes report their measurements at a fixed interval, but each node has
+    its own phase. The interval and phase are learned from the timestamps of the
+    measurements, and the next poll is scheduled shortly after the next report is
+    expected. If a poll doesn't find a new report, the next poll is backed off
+    exponentially until a new report is found.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._interval = SCAN_INTERVAL
+        self._reports = []
+        self._latest = None
+        self._unchanged_polls = 0
+
+    @property
+    def interval(self):
+        """Return the estimated report interval"""
+        return self._interval
+
+    @property
+    def reports(self):
+        """Return the times of the latest reports, oldest first"""
+        return list(self._reports)
+
+    def record(self, measured_at):
+        """Record the timestamp of a fetched measurement"""
+        if measured_at is not None and (self._latest is None or measured_at > self._latest):
+            self._latest = measured_at
+
+    def poll_completed(self):
+        """Update the schedule after a poll.
+        All measurements of the poll must have been recorded.
+        """
+        if self._latest is None or (self._reports and self._latest <= self._reports[-1]):
+            self._unchanged_polls += 1
+            _LOGGER.debug("No new report (name=%s, unchanged polls=%d)" % (self._name, self._unchanged_polls))
+            return
+
+        self._unchanged_polls = 0
+        self._reports = (self._reports + [self._latest])[-REPORT_HISTORY:]
+        self._estimate_interval()
+        _LOGGER.debug("New report at %s (name=%s, interval=%s)" % (self._latest, self._name, self._interval))
+
+    def restore(self, reports):
+        """Continue from the report times of an earlier run, oldest first"""
+        if not reports or self._reports:
+            return
+        self._reports = list(reports)[-REPORT_HISTORY:]
+        self._latest = self._reports[-1]
+        self._estimate_interval()
+
+    def _estimate_interval(self):
+        intervals = [b - a for a, b in zip(self._reports, self._reports[1:])]
+        if intervals:
+            self._interval = max(median(intervals), REPORT_MIN_INTERVAL)
+
+    def next_poll(self, now):
+        """Get the time of the next poll"""
+        if self._unchanged_polls:
+            return now + min(REPORT_POLL_DELAY * 2 ** self._unchanged_polls, REPORT_MAX_BACKOFF)
+
+        if not self._reports:
+            return now + self._interval
+
+        expected = self._reports[-1] + self._interval
+        while expected + REPORT_POLL_DELAY <= now:
+            expected += self._interval
+        return expected + REPORT_POLL_DELAY
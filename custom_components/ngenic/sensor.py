@@ -1,240 +1,395 @@
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import timedelta
+from statistics import mean
 
 from ngenicpy import Ngenic
 from ngenicpy.models.node import NodeType
 from ngenicpy.models.measurement import MeasurementType
 
 from homeassistant.const import (
+    STATE_UNAVAILABLE,
+    STATE_UNKNOWN,
+    EntityCategory,
     UnitOfTemperature,
     UnitOfEnergy,
-    UnitOfPower
+    UnitOfPower,
+    UnitOfTime
 )
 from homeassistant.components.sensor import (
     SensorStateClass,
     SensorEntity,
     SensorDeviceClass,
 )
+from homeassistant.core import callback
+from homeassistant.helpers import entity_registry as er
 from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.restore_state import RestoreEntity
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
 import homeassistant.util.dt as dt_util
 
 from .const import (
     DOMAIN,
-    DATA_CLIENT
+    DATA_CLIENT,
+    DATA_API,
+    DATA_TOPOLOGY,
+    DATA_ENERGY_LEDGER,
+    DATA_MEASUREMENT_STORE,
+    CONF_SETUP_CONCURRENCY,
+    CONF_POWER_HIGH_RESOLUTION,
+    DEFAULT_SETUP_CONCURRENCY,
+    DEFAULT_POWER_HIGH_RESOLUTION,
+    POWER_SAMPLE_PERIOD,
+    POWER_HISTORY_WINDOW,
+    POWER_ROLLING_WINDOW,
+    TEMPERATURE_RATE_WINDOW,
+    TEMPERATURE_RANGE_WINDOW,
+    HUMIDITY_TREND_WINDOW,
+    TOPOLOGY_RETIRE_REFRESHES,
+    API_STATS_INTERVAL
 )
+from .coordinator import NgenicNodeCoordinator
+from .energy import (
+    PERIOD_TODAY,
+    PERIOD_WEEK,
+    PERIOD_MONTH,
+    PERIOD_LAST_MONTH,
+    PERIOD_YEAR,
+    PERIOD_ROLLING_30_DAYS
+)
+from .instrumentation import ENDPOINTS
+from .ringbuffer import NgenicRollingWindow
+from .state_filter import NgenicStateFilter
+from .util import async_gather_limited
 
 _LOGGER = logging.getLogger(__name__)
 
-TIME_ZONE = "Z" if str(dt_util.DEFAULT_TIME_ZONE) == "UTC" else str(dt_util.DEFAULT_TIME_ZONE)
-
-def get_from_to_datetime_month():
-    """Get a period for this month.
-    This will return two dates in ISO 8601:2004 format
-    The first date will be at 00:00 in the first of this month, and the second
-    date will be at 00:00 in the first day in the following month, as we are measuring historic
-    data a month back and forward to todays date its not 
-    an issue that the we have a future end date.
-    
-    Both dates include the time zone name, or `Z` in case of UTC.
-    Including these will allow the API to handle DST correctly. 
-
-    When asking for measurements, the `from` datetime is inclusive
-    and the `to` datetime is exclusive.
-    """
-    from_dt = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    to_dt = (from_dt + timedelta(days=31)).replace(day=1)
-    return (from_dt.isoformat() + " " + TIME_ZONE, 
-            to_dt.isoformat() + " " + TIME_ZONE)
-
-def get_from_to_datetime_last_month():
-    """Get a period for last month.
-    This will return two dates in ISO 8601:2004 format
-    The first date will be at 00:00 in the first of last month, and the second
-    date will be at 00:00 in the first day in this month.
-    
-    Both dates include the time zone name, or `Z` in case of UTC.
-    Including these will allow the API to handle DST correctly. 
-
-    When asking for measurements, the `from` datetime is inclusive
-    and the `to` datetime is exclusive.
+
+async def async_setup_entry(hass, config_entry, async_add_entities):
+    """Set up the sensor platform.
+    Sensors are added at once with their stored or restored state, the initial
+    measurement fetches are run in the background afterwards. These are run
+    concurrently, but never more than the configured number of requests at a time.
+    The sensors follow the topology when it changes, without a reload.
     """
-    to_dt = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    from_dt = (to_dt + timedelta(days=-1)).replace(day=1)
-    return (from_dt.isoformat() + " " + TIME_ZONE, 
-            to_dt.isoformat() + " " + TIME_ZONE)
+    start = time.monotonic()
+    entry_data = hass.data[DOMAIN][config_entry.entry_id]
+    topology = entry_data[DATA_TOPOLOGY]
+    limit = config_entry.options.get(CONF_SETUP_CONCURRENCY, DEFAULT_SETUP_CONCURRENCY)
+
+    # node uuid -> NgenicNodeSensors
+    node_sensors = {}
+    devices, coordinators = _async_apply_topology(hass, entry_data, node_sensors, config_entry.options)
+
+    async def async_refresh(coordinators):
+        """Fetch every measurement that is not deferred and not current since the last run"""
+        start = time.monotonic()
+        await async_gather_limited(limit, *[coordinator.async_refresh() for coordinator in coordinators])
+        _LOGGER.info("Refresh of %d nodes took %.2f seconds" % (len(coordinators), time.monotonic() - start))
+
+    @callback
+    def async_topology_changed():
+        """Add sensors of new nodes and measurement types, the others are kept as they are"""
+        devices, coordinators = _async_apply_topology(hass, entry_data, node_sensors, config_entry.options)
+        if devices:
+            async_add_entities(devices)
+            config_entry.async_create_background_task(hass, async_refresh(coordinators), "ngenic refresh %s" % config_entry.entry_id)
+
+    config_entry.async_on_unload(topology.async_add_listener(async_topology_changed))
+
+    # Diagnostic sensors of the requests made to the API
+    api = entry_data[DATA_API]
+    devices.append(NgenicApiRequestsSensor(api, config_entry))
+    devices.append(NgenicApiErrorsSensor(api, config_entry))
+    devices.extend(NgenicApiLatencySensor(api, config_entry, endpoint) for endpoint in ENDPOINTS)
 
+    # Add entities to hass (and trigger a state update)
+    # The coordinator update timer is started once its entities are added
+    async_add_entities(devices)
 
-def get_from_to_datetime(days=1):
-    """Get a period
-    This will return two dates in ISO 8601:2004 format
-    The first date will be at 00:00 today, and the second
-    date will be at 00:00 n days ahead of now.
+    _LOGGER.info("Setup of %d sensors for %d nodes took %.2f seconds" %
+        (len(devices), len(node_sensors), time.monotonic() - start))
 
-    Both dates include the time zone name, or `Z` in case of UTC.
-    Including these will allow the API to handle DST correctly. 
+    # Initial update, Home Assistant doesn't wait for it to finish starting
+    config_entry.async_create_background_task(hass, async_refresh(coordinators), "ngenic first refresh %s" % config_entry.entry_id)
 
-    When asking for measurements, the `from` datetime is inclusive
-    and the `to` datetime is exclusive. 
+def _get_node_name(node, rooms):
+    """Get the name of a node and the room it is connected to.
+    Return a tuple with the name and the room, or None if it isn't connected to a room.
     """
-    from_dt = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    to_dt = from_dt + timedelta(days=days)
-
-    return (from_dt.isoformat() + " " + TIME_ZONE, 
-            to_dt.isoformat() + " " + TIME_ZONE)
-
-async def get_measurement_value(node, **kwargs):
-    """Get measurement 
-    This is a wrapper around the measurement API to gather
-    parsing and error handling in a single place.
+    node_name = "Ngenic %s" % node.get_type().name.lower()
+
+    if node.get_type() == NodeType.SENSOR:
+        # If this sensor is connected to a room
+        # we'll use the room name as the sensor name
+        for room in rooms:
+            if room["nodeUuid"] == node.uuid():
+                return "%s %s" % (node_name, room["name"]), room
+
+    return node_name, None
+
+@callback
+def _async_apply_topology(hass, entry_data, node_sensors, options):
+    """Make the sensors in `node_sensors` follow the topology.
+    Sensors are created for new nodes and measurement types and sensors of renamed rooms
+    are renamed. The sensors of nodes and measurement types missing from the topology are
+    unavailable, and are retired once they have been missing for TOPOLOGY_RETIRE_REFRESHES
+    refreshes, so a single incomplete answer of the API doesn't remove them.
+    Coordinators, histories and schedules of nodes that are kept are not touched.
+    Return a tuple with the new sensors and the coordinators that should be refreshed.
     """
-    measurement = await node.async_measurement(**kwargs)
-    if not measurement:
-        # measurement API will return None if no measurements were found for the period
-        _LOGGER.info("Measurement not found for period, this is expected when data have not been gathered for the period (type=%s, from=%s, to=%s)" % 
-            (
-                kwargs.get("measurement_type", "unknown"), 
-                kwargs.get("from_dt", "None"), 
-                kwargs.get("to_dt", "None")
-            )
-        )
-        measurement_val = 0
-    else:
-        if isinstance(measurement, list):
-            # using datetime will return a list of measurements
-            # we'll use the last item in that list
-            measurement_val = measurement[-1]["value"]
-        else:
-            measurement_val = measurement["value"]
-
-    return measurement_val
-
-async def async_setup_entry(hass, config_entry, async_add_entities):
-    """Set up the sensor platform."""
-    ngenic = hass.data[DOMAIN][DATA_CLIENT]
-
+    topology = entry_data[DATA_TOPOLOGY]
     devices = []
+    coordinators = []
+    node_uuids = set()
+
+    for tune in topology.tunes:
+        for node in tune.nodes:
+            node_uuids.add(node.uuid())
+            node_name, node_room = _get_node_name(node, tune.rooms)
+            sensors = node_sensors.get(node.uuid())
+            if sensors is None:
+                # all sensors of a node share a single coordinator
+                coordinator = NgenicNodeCoordinator(hass, entry_data[DATA_API], node, node_name, entry_data[DATA_MEASUREMENT_STORE])
+                sensors = node_sensors[node.uuid()] = NgenicNodeSensors(coordinator, node_name)
+            elif sensors.name != node_name:
+                sensors.async_rename(node_name)
+
+            measurement_types = topology.measurement_types(node)
+            for measurement_type in sensors.measurement_types - set(measurement_types):
+                sensors.async_set_missing(hass, measurement_type, topology.refreshes)
+            for measurement_type in sensors.measurement_types & set(measurement_types):
+                sensors.async_set_present(measurement_type)
+
+            new_types = [measurement_type for measurement_type in measurement_types if measurement_type not in sensors.measurement_types]
+            if new_types:
+                new_devices = _create_node_sensors(hass, entry_data, sensors.coordinator, node, node_room, node_name, new_types, options)
+                sensors.add(new_types, new_devices)
+                devices.extend(new_devices)
+                coordinators.append(sensors.coordinator)
+
+    for node_uuid in node_sensors.keys() - node_uuids:
+        sensors = node_sensors[node_uuid]
+        for measurement_type in sensors.measurement_types:
+            sensors.async_set_missing(hass, measurement_type, topology.refreshes)
+        if not sensors.measurement_types:
+            _LOGGER.info("Retired the sensors of removed node %s" % node_uuid)
+            node_sensors.pop(node_uuid).async_retire_all(hass)
+
+    # the stored measurements of nodes that are only missing are kept until their sensors are retired
+    entry_data[DATA_MEASUREMENT_STORE].async_prune(set(node_sensors))
+
+    return devices, coordinators
+
+class NgenicNodeSensors:
+    """The coordinator and sensors of a node, grouped by measurement type"""
+
+    def __init__(self, coordinator, name):
+        self.coordinator = coordinator
+        self.name = name
+
+        # measurement type -> list of sensors
+        self._sensors = {}
+
+        # measurement type -> refresh of the topology it was first missing from
+        self._missing = {}
 
-    for tune in await ngenic.async_tunes():
-        rooms = await tune.async_rooms()
-
-        for node in await tune.async_nodes():
-            node_name = "Ngenic %s" % node.get_type().name.lower()
-            node_room = None
-
-            if node.get_type() == NodeType.SENSOR:
-                # If this sensor is connected to a room
-                # we'll use the room name as the sensor name
-                for room in rooms:
-                    if room["nodeUuid"] == node.uuid():
-                        node_name = "%s %s" % (node_name, room["name"])
-                        node_room = room
-                        break
-
-            measurement_types = await node.async_measurement_types()
-            if MeasurementType.TEMPERATURE in measurement_types:
-                devices.append(
-                    NgenicTempSensor(
-                        hass,
-                        ngenic,
-                        node_room,
-                        node,
-                        node_name,
-                        timedelta(minutes=5),
-                        MeasurementType.TEMPERATURE
-                    )
-                )
-
-            if MeasurementType.CONTROL_VALUE in measurement_types:
-                # append "control" so it doesn't collide with control temperature
-                # this will become "Ngenic controller control temperature"
-                node_name = "%s %s" % (node_name, "control")
-                devices.append(
-                    NgenicTempSensor(
-                        hass,
-                        ngenic,
-                        node_room,
-                        node,
-                        node_name,
-                        timedelta(minutes=5),
-                        MeasurementType.CONTROL_VALUE
-                    )
-                )
-            
-            if MeasurementType.HUMIDITY in measurement_types:
-                devices.append(
-                    NgenicHumiditySensor(
-                        hass,
-                        ngenic,
-                        node_room,
-                        node,
-                        node_name,
-                        timedelta(minutes=5),
-                        MeasurementType.HUMIDITY
-                    )
-                )
+    @property
+    def measurement_types(self):
+        return set(self._sensors)
+
+    def add(self, measurement_types, devices):
+        """Add the sensors created for new measurement types"""
+        for measurement_type in measurement_types:
+            self._sensors[measurement_type] = [device for device in devices if device._measurement_type == measurement_type]
+
+    @callback
+    def async_rename(self, name):
+        """Replace the node name at the start of the name of every sensor"""
+        _LOGGER.info("Renaming sensors of %s to %s" % (self.name, name))
+        for devices in self._sensors.values():
+            for device in devices:
+                if device._name.startswith(self.name):
+                    device._name = name + device._name[len(self.name):]
+                if device.hass is not None:
+                    device.async_write_ha_state()
+        self.coordinator.name = name
+        self.name = name
+
+    @callback
+    def async_set_missing(self, hass, measurement_type, refreshes):
+        """Make the sensors of a measurement type missing from the topology unavailable,
+        and retire them once they have been missing for TOPOLOGY_RETIRE_REFRESHES refreshes
+        """
+        if measurement_type not in self._missing:
+            _LOGGER.info("%s sensors of %s are missing from the topology" % (measurement_type, self.name))
+            self._missing[measurement_type] = refreshes
+            for device in self._sensors[measurement_type]:
+                self.coordinator.async_pause_fetcher(device.unique_id)
+
+        if refreshes - self._missing[measurement_type] + 1 >= TOPOLOGY_RETIRE_REFRESHES:
+            self.async_retire(hass, measurement_type)
+
+    @callback
+    def async_set_present(self, measurement_type):
+        """Fetch the sensors of a measurement type again once it is back in the topology"""
+        if self._missing.pop(measurement_type, None) is not None:
+            _LOGGER.info("%s sensors of %s are back in the topology" % (measurement_type, self.name))
+            for device in self._sensors[measurement_type]:
+                self.coordinator.async_resume_fetcher(device.unique_id)
+
+    @callback
+    def async_retire(self, hass, measurement_type):
+        """Remove the sensors of a measurement type the node no longer has"""
+        _LOGGER.info("Retiring %s sensors of %s" % (measurement_type, self.name))
+        registry = er.async_get(hass)
+        self._missing.pop(measurement_type, None)
+        for device in self._sensors.pop(measurement_type):
+            self.coordinator.async_remove_fetcher(device.unique_id)
+            if device.entity_id is not None and registry.async_get(device.entity_id) is not None:
+                # the entity removes itself when it is removed from the registry
+                registry.async_remove(device.entity_id)
+            elif device.hass is not None:
+                hass.async_create_task(device.async_remove())
+
+    @callback
+    def async_retire_all(self, hass):
+        """Remove all sensors of a node that has been removed, and stop its coordinator"""
+        for measurement_type in list(self._sensors):
+            self.async_retire(hass, measurement_type)
+        hass.async_create_task(self.coordinator.async_shutdown())
+
+def _create_node_sensors(hass, entry_data, coordinator, node, node_room, node_name, measurement_types, options):
+    """Create the sensors of measurement types of a single node.
+    Return a list of sensors.
+    """
+    ngenic = entry_data[DATA_CLIENT]
+    devices = []
 
-            if MeasurementType.POWER_KW in measurement_types:
-                devices.append(
-                    NgenicPowerSensor(
-                        hass,
-                        ngenic,
-                        node_room,
-                        node,
-                        node_name,
-                        timedelta(minutes=1),
-                        MeasurementType.POWER_KW
-                    )
-                )
+    if MeasurementType.TEMPERATURE in measurement_types:
+        temp_sensor = NgenicTempSensor(
+            hass,
+            ngenic,
+            coordinator,
+            node_room,
+            node,
+            node_name,
+            None,
+            MeasurementType.TEMPERATURE,
+            state_filter=NgenicStateFilter.from_options(options, "temperature")
+        )
+        devices.extend([
+            temp_sensor,
+            NgenicTempRateSensor(coordinator, node, node_name, temp_sensor.unique_id,
+                MeasurementType.TEMPERATURE, "rate", "temperature rate", TEMPERATURE_RATE_WINDOW),
+            NgenicTempRangeSensor(coordinator, node, node_name, temp_sensor.unique_id,
+                MeasurementType.TEMPERATURE, "min_24h", "temperature 24h min", TEMPERATURE_RANGE_WINDOW),
+            NgenicTempRangeSensor(coordinator, node, node_name, temp_sensor.unique_id,
+                MeasurementType.TEMPERATURE, "max_24h", "temperature 24h max", TEMPERATURE_RANGE_WINDOW)
+        ])
+
+    if MeasurementType.CONTROL_VALUE in measurement_types:
+        # append "control" so it doesn't collide with control temperature
+        # this will become "Ngenic controller control temperature"
+        node_name = "%s %s" % (node_name, "control")
+        devices.append(
+            NgenicTempSensor(
+                hass,
+                ngenic,
+                coordinator,
+                node_room,
+                node,
+                node_name,
+                None,
+                MeasurementType.CONTROL_VALUE,
+                state_filter=NgenicStateFilter.from_options(options, "temperature")
+            )
+        )
 
-            if MeasurementType.ENERGY_KWH in measurement_types:
-                devices.append(
-                    NgenicEnergySensor(
-                        hass,
-                        ngenic,
-                        node_room,
-                        node,
-                        node_name,
-                        timedelta(minutes=10),
-                        MeasurementType.ENERGY_KWH
-                    )
-                )
-                devices.append(
-                    NgenicEnergySensorMonth(
-                        hass,
-                        ngenic,
-                        node_room,
-                        node,
-                        node_name,
-                        timedelta(minutes=20),
-                        MeasurementType.ENERGY_KWH
-                    )
-                )
-                devices.append(
-                    NgenicEnergySensorLastMonth(
-                        hass,
-                        ngenic,
-                        node_room,
-                        node,
-                        node_name,
-                        timedelta(minutes=60),
-                        MeasurementType.ENERGY_KWH
-                    )
+    if MeasurementType.HUMIDITY in measurement_types:
+        humidity_sensor = NgenicHumiditySensor(
+            hass,
+            ngenic,
+            coordinator,
+            node_room,
+            node,
+            node_name,
+            None,
+            MeasurementType.HUMIDITY,
+            state_filter=NgenicStateFilter.from_options(options, "humidity")
+        )
+        devices.extend([
+            humidity_sensor,
+            NgenicHumidityTrendSensor(coordinator, node, node_name, humidity_sensor.unique_id,
+                MeasurementType.HUMIDITY, "rate", "humidity trend", HUMIDITY_TREND_WINDOW)
+        ])
+
+    if MeasurementType.POWER_KW in measurement_types:
+        # the power series is only fetched in high resolution mode, and needs a larger history
+        high_resolution = options.get(CONF_POWER_HIGH_RESOLUTION, DEFAULT_POWER_HIGH_RESOLUTION)
+        if high_resolution:
+            coordinator.history(MeasurementType.POWER_KW, int(POWER_HISTORY_WINDOW / POWER_SAMPLE_PERIOD))
+
+        power_sensor = NgenicPowerSensor(
+            hass,
+            ngenic,
+            coordinator,
+            node_room,
+            node,
+            node_name,
+            None,
+            MeasurementType.POWER_KW,
+            state_filter=NgenicStateFilter.from_options(options, "power"),
+            high_resolution=high_resolution
+        )
+        devices.append(power_sensor)
+
+        if high_resolution:
+            devices.extend([
+                NgenicPowerWindowSensor(coordinator, node, node_name, power_sensor.unique_id,
+                    MeasurementType.POWER_KW, "mean", "power rolling mean", POWER_ROLLING_WINDOW),
+                NgenicPowerWindowSensor(coordinator, node, node_name, power_sensor.unique_id,
+                    MeasurementType.POWER_KW, "min", "power rolling min", POWER_ROLLING_WINDOW),
+                NgenicPowerWindowSensor(coordinator, node, node_name, power_sensor.unique_id,
+                    MeasurementType.POWER_KW, "max", "power rolling max", POWER_ROLLING_WINDOW),
+                NgenicPowerPeakHourSensor(coordinator, node, node_name, power_sensor.unique_id,
+                    MeasurementType.POWER_KW, "peak_hour", "power peak hour")
+            ])
+
+    if MeasurementType.ENERGY_KWH in measurement_types:
+        # every period is derived from the same daily energy series of the node
+        for sensor_class, update_interval in (
+            (NgenicEnergySensor, timedelta(minutes=10)),
+            (NgenicEnergySensorWeek, timedelta(minutes=20)),
+            (NgenicEnergySensorMonth, timedelta(minutes=20)),
+            (NgenicEnergySensorLastMonth, timedelta(minutes=60)),
+            (NgenicEnergySensorYear, timedelta(minutes=60)),
+            (NgenicEnergySensorRolling30Days, timedelta(minutes=20))
+        ):
+            devices.append(
+                sensor_class(
+                    hass,
+                    ngenic,
+                    coordinator,
+                    node_room,
+                    node,
+                    node_name,
+                    update_interval,
+                    MeasurementType.ENERGY_KWH,
+                    energy_ledger=entry_data[DATA_ENERGY_LEDGER]
                 )
+            )
 
-    for device in devices:
-        # Initial update (will not update hass state)
-        await device._async_update()
+    return devices
 
-        # Setup update timer
-        device._setup_updater()
+class NgenicSensor(CoordinatorEntity, SensorEntity, RestoreEntity):
+    """Representation of an Ngenic Sensor"""
 
-    # Add entities to hass (and trigger a state update)
-    async_add_entities(devices, update_before_add=True)
+    # fetch the measurement only once Home Assistant has started
+    deferred = False
 
-class NgenicSensor(SensorEntity):
-    """Representation of an Ngenic Sensor"""
-    
-    def __init__(self, hass, ngenic, room, node, name, update_interval, measurement_type):
+    def __init__(self, hass, ngenic, coordinator, room, node, name, update_interval, measurement_type, state_filter=None):
+        super().__init__(coordinator)
         self._hass = hass
         self._state = None
         self._available = False
@@ -243,11 +398,23 @@ class NgenicSensor(SensorEntity):
         self._node = node
         self._update_interval = update_interval
         self._measurement_type = measurement_type
-        self._updater = None
         self._attributes = dict()
+
+        # new values that don't pass the filter are not written to Home Assistant
+        self._state_filter = state_filter
         if room is not None:
             self._attributes["room_uuid"] = room.uuid()
 
+        # let the node coordinator fetch this sensors measurement
+        # an update interval of None will fetch the measurement when the node reports
+        coordinator.async_add_fetcher(
+            self.unique_id,
+            update_interval,
+            self._async_fetch_measurement,
+            self._restore_measurement,
+            self.deferred
+        )
+
     @property
     def name(self):
         """Return the name of the sensor."""
@@ -276,16 +443,20 @@ class NgenicSensor(SensorEntity):
         """Return entity specific state attributes"""
         return self._attributes
 
-    async def async_will_remove_from_hass(self):
-        """Remove updater when sensor is removed."""
-        if self._updater:
-            self._updater()
-            self._updater = None
-
-    def _setup_updater(self):
-        """Setup a timer that will execute an update every update interval"""
-        # async_track_time_interval returns a function that, when executed, will remove the timer
-        self._updater = async_track_time_interval(self._hass, self._async_update, self._update_interval)
+    async def async_added_to_hass(self):
+        """Load the state from the coordinator.
+        If the measurement has neither been fetched nor stored, the state
+        of the last run is shown until the measurement has been fetched.
+        """
+        await super().async_added_to_hass()
+        if not self.coordinator.has_data(self.unique_id):
+            last_state = await self.async_get_last_state()
+            if last_state is not None and last_state.state not in (STATE_UNKNOWN, STATE_UNAVAILABLE):
+                try:
+                    self.coordinator.restore(self.unique_id, float(last_state.state), last_state.last_updated.timestamp())
+                except ValueError:
+                    _LOGGER.debug("Can't restore state %s (name=%s)" % (last_state.state, self._name))
+        self._async_update()
 
     async def _async_fetch_measurement(self):
         """Fetch the measurement data from ngenic API.
@@ -293,36 +464,59 @@ class NgenicSensor(SensorEntity):
         Concrete classes should override this function if they
         fetch or format the measurement differently.
         """
-        current = await get_measurement_value(self._node, measurement_type=self._measurement_type)
-        return round(current, 1)
+        current = await self.coordinator.async_latest_measurement(self._measurement_type)
+        return self._format_measurement(current)
+
+    def _format_measurement(self, value):
+        """Format a measurement value as intended to be displayed in hass"""
+        return round(value, 1)
 
-    async def _async_update(self, event_time=None):
-        """Fetch new state data for the sensor.
-        This is the only method that should fetch new data for Home Assistant.
+    def _restore_measurement(self):
+        """Get the latest measurement in the stored history of the node.
+        Return a tuple of the formatted value and its timestamp, or None if there is none.
+        """
+        history = self.coordinator.history(self._measurement_type)
+        if history.latest_time is None:
+            return None
+        return self._format_measurement(history.latest_value), history.latest_time
+
+    @callback
+    def _handle_coordinator_update(self):
+        """Handle updated data from the node coordinator."""
+        if self._async_update():
+            # Tell hass that an update is available
+            self.async_write_ha_state()
+
+    @callback
+    def _async_update(self):
+        """Read new state data for the sensor from the coordinator.
+        The coordinator is the only one that should fetch new data for Home Assistant.
+        Return True if the state or availability of the sensor changed.
         """
-        _LOGGER.debug("Fetch measurement (name=%s, type=%s)" % (self._name, self._measurement_type))
-        try:
-            new_state = await self._async_fetch_measurement()
-            self._available = True
-        except Exception:
-            # Don't throw an exception if a sensor fails to update.
-            # Instead, make the sensor unavailable.
-            _LOGGER.exception("Failed to update sensor '%s'" % self.unique_id)
+        available = self.coordinator.is_available(self.unique_id)
+        if not available:
+            changed = self._available
             self._available = False
-            return
-        
+            return changed
+
+        changed = not self._available
+        self._available = True
+
+        new_state = self.coordinator.data[self.unique_id]
         if self._state != new_state:
+            now = dt_util.utcnow()
+            if self._state_filter is not None:
+                if not changed and not self._state_filter.should_write(self._state, new_state, now):
+                    _LOGGER.debug("Holding back measurement: %f (written=%f, name=%s, type=%s)" % (new_state, self._state, self._name, self._measurement_type))
+                    return False
+                self._state_filter.written(now)
+
             self._state = new_state
             _LOGGER.debug("New measurement: %f (name=%s, type=%s)" % (new_state, self._name, self._measurement_type))
-            
-            # self.hass is loaded once the entity have been setup.
-            # Since this method is executed before adding the entity
-            # the hass object might not have been loaded yet. 
-            if self.hass:
-                # Tell hass that an update is available
-                self.schedule_update_ha_state()
-        else:
-            _LOGGER.debug("No new measurement (old=%f, name=%s, type=%s)" % (new_state, self._name, self._measurement_type))
+            return True
+
+        _LOGGER.debug("No new measurement (old=%f, name=%s, type=%s)" % (new_state, self._name, self._measurement_type))
+        return changed
 
 class NgenicTempSensor(NgenicSensor):
     device_class = SensorDeviceClass.TEMPERATURE
@@ -346,6 +540,11 @@ class NgenicPowerSensor(NgenicSensor):
     device_class = SensorDeviceClass.POWER
     state_class = SensorStateClass.MEASUREMENT
 
+    def __init__(self, *args, high_resolution=False, **kwargs):
+        # in high resolution mode the power series is fetched into the history of the node
+        self._high_resolution = high_resolution
+        super().__init__(*args, **kwargs)
+
     @property
     def unit_of_measurement(self):
         """Return the unit of measurement."""
@@ -355,12 +554,141 @@ class NgenicPowerSensor(NgenicSensor):
         """Fetch new power state data for the sensor.
         The NGenic API returns a float with kW but HA huses W so we need to multiply by 1000
         """
-        current = await get_measurement_value(self._node, measurement_type=self._measurement_type)
-        return round(current*1000.0, 1)
-        
-class NgenicEnergySensor(NgenicSensor):
+        if self._high_resolution:
+            current = await self.coordinator.async_measurement_series(
+                self._measurement_type,
+                POWER_HISTORY_WINDOW,
+                POWER_SAMPLE_PERIOD
+            )
+        else:
+            current = await self.coordinator.async_latest_measurement(self._measurement_type)
+        return self._format_measurement(current)
+
+    def _format_measurement(self, value):
+        return round(value*1000.0, 1)
+
+class NgenicHistorySensor(CoordinatorEntity, SensorEntity):
+    """Base of the sensors derived from the history of a measurement type of a node.
+    The history is fed by the fetches of the measurement sensor with the key `source_key`,
+    so these sensors make no requests of their own.
+    """
+    state_class = SensorStateClass.MEASUREMENT
+
+    # multiplied with the derived value, e.g. to convert kW to W
+    scale = 1.0
+
+    def __init__(self, coordinator, node, name, source_key, measurement_type, statistic, label):
+        super().__init__(coordinator)
+        self._node = node
+        self._name = name
+        self._source_key = source_key
+        self._measurement_type = measurement_type
+        self._history = coordinator.history(measurement_type)
+        self._statistic = statistic
+        self._label = label
+
+    @property
+    def name(self):
+        return "%s %s" % (self._name, self._label)
+
+    @property
+    def unique_id(self):
+        return "%s-%s-%s-%s" % (self._node.uuid(), self._measurement_type.name, "sensor", self._statistic)
+
+    @property
+    def available(self):
+        return self.coordinator.is_available(self._source_key)
+
+    @property
+    def native_value(self):
+        value = self._derive()
+        if value is None:
+            return None
+        return round(value*self.scale, 2)
+
+    def _derive(self):
+        """Return the derived value, or None if there are too few samples.
+        Concrete classes must override this function.
+        """
+        raise NotImplementedError
+
+class NgenicWindowSensor(NgenicHistorySensor):
+    """A sensor derived from the samples within a rolling window of the history.
+    The statistic is `mean`, `min`, `max` or `rate` (change per hour).
+    """
+
+    def __init__(self, coordinator, node, name, source_key, measurement_type, statistic, label, window):
+        super().__init__(coordinator, node, name, source_key, measurement_type, statistic, label)
+        self._window = NgenicRollingWindow(self._history, window)
+
+    def _derive(self):
+        if self._statistic.startswith("rate"):
+            return self._window.rate(timedelta(hours=1))
+        if self._statistic.startswith("mean"):
+            return self._window.mean
+        if self._statistic.startswith("min"):
+            return self._window.min
+        return self._window.max
+
+class NgenicTempRangeSensor(NgenicWindowSensor):
+    device_class = SensorDeviceClass.TEMPERATURE
+    native_unit_of_measurement = UnitOfTemperature.CELSIUS
+
+class NgenicTempRateSensor(NgenicWindowSensor):
+    native_unit_of_measurement = "%s/h" % UnitOfTemperature.CELSIUS
+
+class NgenicHumidityTrendSensor(NgenicWindowSensor):
+    native_unit_of_measurement = "%/h"
+
+class NgenicPowerWindowSensor(NgenicWindowSensor):
+    device_class = SensorDeviceClass.POWER
+    native_unit_of_measurement = UnitOfPower.WATT
+    scale = 1000.0
+
+class NgenicPowerPeakHourSensor(NgenicHistorySensor):
+    """The highest mean power of an hour today, with the hour as an attribute"""
+    device_class = SensorDeviceClass.POWER
+    native_unit_of_measurement = UnitOfPower.WATT
+    scale = 1000.0
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._peak_hour = None
+
+    @property
+    def extra_state_attributes(self):
+        if self._peak_hour is None:
+            return None
+        return {"hour": self._peak_hour.isoformat()}
+
+    def _derive(self):
+        """Get the highest mean power of an hour today, and remember which hour it was"""
+        hours = {}
+        for timestamp, value in self._history.samples(since=dt_util.start_of_local_day().timestamp()):
+            hours.setdefault(timestamp // 3600, []).append(value)
+
+        if not hours:
+            self._peak_hour = None
+            return None
+
+        hour, value = max(((hour, mean(values)) for hour, values in hours.items()), key=lambda item: item[1])
+        self._peak_hour = dt_util.as_local(dt_util.utc_from_timestamp(hour * 3600))
+        return value
+
+class NgenicEnergyLedgerSensor(NgenicSensor):
+    """A sensor that reads the energy of a period from the energy ledger of its config entry.
+    All periods are summed from the same daily series, open days fetched for one
+    period are reused by the others for up to the update interval of the sensor.
+    """
     device_class = SensorDeviceClass.ENERGY
-    state_class = SensorStateClass.TOTAL_INCREASING
+    period = PERIOD_TODAY
+
+    # the first query of the ledger fetches the days of all periods, which is slow
+    deferred = True
+
+    def __init__(self, *args, energy_ledger):
+        self._energy_ledger = energy_ledger
+        super().__init__(*args)
 
     @property
     def unit_of_measurement(self):
@@ -368,38 +696,36 @@ class NgenicEnergySensor(NgenicSensor):
         return UnitOfEnergy.KILO_WATT_HOUR
 
     async def _async_fetch_measurement(self):
-        """Ask for measurements for a duration.
-        This requires some further inputs, so we'll override the _async_fetch_measurement method.
-        """
-        from_dt, to_dt = get_from_to_datetime()
-        # using datetime will return a list of measurements
-        # we'll use the last item in that list
-        current = await get_measurement_value(self._node, measurement_type=self._measurement_type, from_dt=from_dt, to_dt=to_dt)
+        """Ask the energy ledger for the energy consumed during the period."""
+        current = await self._energy_ledger.async_period(self._node, self.period, self._update_interval)
         return round(current, 1)
-        
+
+    def _restore_measurement(self):
+        """Periods are summed from the energy ledger, which keeps its own days"""
+        return None
+
+class NgenicEnergySensor(NgenicEnergyLedgerSensor):
+    state_class = SensorStateClass.TOTAL_INCREASING
+
     @property
     def name(self):
         """Return the name of the sensor."""
         return "%s %s" % (self._name, "energy")
 
-class NgenicEnergySensorMonth(NgenicSensor):
-    device_class = SensorDeviceClass.ENERGY
+class NgenicEnergySensorWeek(NgenicEnergyLedgerSensor):
+    period = PERIOD_WEEK
 
     @property
-    def unit_of_measurement(self):
-        """Return the unit of measurement."""
-        return UnitOfEnergy.KILO_WATT_HOUR
+    def name(self):
+        """Return the name of the sensor."""
+        return "%s %s" % (self._name, "weekly energy")
 
-    async def _async_fetch_measurement(self):
-        """Ask for measurements for a duration.
-        This requires some further inputs, so we'll override the _async_fetch_measurement method.
-        """
-        from_dt, to_dt = get_from_to_datetime_month()
-        # using datetime will return a list of measurements
-        # we'll use the last item in that list
-        # dont send any period so the response includes the whole timespan
-        current = await get_measurement_value(self._node, measurement_type=self._measurement_type, from_dt=from_dt, to_dt=to_dt)
-        return round(current, 1)
+    @property
+    def unique_id(self):
+        return "%s-%s-%s-week" % (self._node.uuid(), self._measurement_type.name, "sensor")
+
+class NgenicEnergySensorMonth(NgenicEnergyLedgerSensor):
+    period = PERIOD_MONTH
 
     @property
     def name(self):
@@ -410,27 +736,143 @@ class NgenicEnergySensorMonth(NgenicSensor):
     def unique_id(self):
         return "%s-%s-%s-month" % (self._node.uuid(), self._measurement_type.name, "sensor")
 
-class NgenicEnergySensorLastMonth(NgenicSensor):
-    device_class = SensorDeviceClass.ENERGY
+class NgenicEnergySensorLastMonth(NgenicEnergyLedgerSensor):
+    period = PERIOD_LAST_MONTH
 
     @property
-    def unit_of_measurement(self):
-        """Return the unit of measurement."""
-        return UnitOfEnergy.KILO_WATT_HOUR
+    def name(self):
+        """Return the name of the sensor."""
+        return "%s %s" % (self._name, "last month energy")
 
-    async def _async_fetch_measurement(self):
-        """Ask for measurements for a duration.
-        This requires some further inputs, so we'll override the _async_fetch_measurement method.
-        """
-        from_dt, to_dt = get_from_to_datetime_last_month()
-        current = await get_measurement_value(self._node, measurement_type=self._measurement_type, from_dt=from_dt, to_dt=to_dt)
-        return round(current, 1)
+    @property
+    def unique_id(self):
+        return "%s-%s-%s-last-month" % (self._node.uuid(), self._measurement_type.name, "sensor")
+
+class NgenicEnergySensorYear(NgenicEnergyLedgerSensor):
+    period = PERIOD_YEAR
 
     @property
     def name(self):
         """Return the name of the sensor."""
-        return "%s %s" % (self._name, "last month energy")
+        return "%s %s" % (self._name, "yearly energy")
 
     @property
     def unique_id(self):
-        return "%s-%s-%s-last-month" % (self._node.uuid(), self._measurement_type.name, "sensor")
+        return "%s-%s-%s-year" % (self._node.uuid(), self._measurement_type.name, "sensor")
+
+class NgenicEnergySensorRolling30Days(NgenicEnergyLedgerSensor):
+    period = PERIOD_ROLLING_30_DAYS
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return "%s %s" % (self._name, "last 30 days energy")
+
+    @property
+    def unique_id(self):
+        return "%s-%s-%s-rolling-30-days" % (self._node.uuid(), self._measurement_type.name, "sensor")
+
+class NgenicApiSensor(SensorEntity):
+    """Base of the diagnostic sensors of the API request statistics.
+    The statistics are kept in memory and change with almost every request,
+    so the state is only written every API_STATS_INTERVAL, and the attributes
+    are not recorded.
+    """
+    entity_category = EntityCategory.DIAGNOSTIC
+    should_poll = False
+
+    def __init__(self, api, config_entry):
+        self._api = api
+        self._entry_id = config_entry.entry_id
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(async_track_time_interval(self.hass, self._async_write_stats, API_STATS_INTERVAL))
+
+    @callback
+    def _async_write_stats(self, now):
+        self.async_write_ha_state()
+
+class NgenicApiRequestsSensor(NgenicApiSensor):
+    state_class = SensorStateClass.TOTAL_INCREASING
+    _unrecorded_attributes = frozenset({"cache_hits", "coalesced", *ENDPOINTS})
+
+    @property
+    def name(self):
+        return "Ngenic API requests"
+
+    @property
+    def unique_id(self):
+        return "%s-api-requests" % self._entry_id
+
+    @property
+    def native_value(self):
+        return self._api.stats.requests
+
+    @property
+    def extra_state_attributes(self):
+        stats = self._api.stats
+        attributes = {
+            "cache_hits": stats.cache_hits,
+            "coalesced": stats.coalesced
+        }
+        for endpoint, endpoint_stats in stats.endpoints.items():
+            attributes[endpoint] = endpoint_stats.requests
+        return attributes
+
+class NgenicApiErrorsSensor(NgenicApiSensor):
+    state_class = SensorStateClass.TOTAL_INCREASING
+    _unrecorded_attributes = frozenset(ENDPOINTS)
+
+    @property
+    def name(self):
+        return "Ngenic API errors"
+
+    @property
+    def unique_id(self):
+        return "%s-api-errors" % self._entry_id
+
+    @property
+    def native_value(self):
+        return self._api.stats.errors
+
+    @property
+    def extra_state_attributes(self):
+        return {
+            endpoint: endpoint_stats.errors
+            for endpoint, endpoint_stats in self._api.stats.endpoints.items()
+        }
+
+class NgenicApiLatencySensor(NgenicApiSensor):
+    """Average latency of an endpoint, with its histogram as attributes.
+    Disabled by default as there is one per endpoint.
+    """
+    device_class = SensorDeviceClass.DURATION
+    state_class = SensorStateClass.MEASUREMENT
+    native_unit_of_measurement = UnitOfTime.MILLISECONDS
+    entity_registry_enabled_default = False
+    _unrecorded_attributes = frozenset({
+        "requests", "errors", "average_latency", "max_latency", "latency_histogram", "last_error"
+    })
+
+    def __init__(self, api, config_entry, endpoint):
+        super().__init__(api, config_entry)
+        self._endpoint = endpoint
+
+    @property
+    def name(self):
+        return "Ngenic API %s latency" % self._endpoint.replace("_", " ")
+
+    @property
+    def unique_id(self):
+        return "%s-api-%s-latency" % (self._entry_id, self._endpoint)
+
+    @property
+    def native_value(self):
+        latency = self._api.stats.endpoints[self._endpoint].average_latency
+        if latency is None:
+            return None
+        return round(latency * 1000, 1)
+
+    @property
+    def extra_state_attributes(self):
+        return self._api.stats.endpoints[self._endpoint].as_dict()
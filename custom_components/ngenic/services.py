@@ -1,35 +1,107 @@
+import asyncio
 import logging
+from datetime import timedelta
 
 import voluptuous as vol
 
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.service import verify_domain_control
+import homeassistant.util.dt as dt_util
 
 from .const import (
     DOMAIN,
-    DATA_CLIENT,
-    SERVICE_SET_ACTIVE_CONTROL
+    DATA_API,
+    DATA_TOPOLOGY,
+    SERVICE_SET_ACTIVE_CONTROL,
+    SERVICE_IMPORT_STATISTICS
 )
+from .statistics import NgenicStatisticsImporter
+from .util import async_loaded_entries
 
 _LOGGER = logging.getLogger(__name__)
 
 def async_register_services(hass):
     """Register services for Ngenic integration."""
 
+    def find_room(room_uuid):
+        """Find a room in the topology of any config entry.
+        Return a tuple with the api, tune and room, or None if there is no such room.
+        """
+        for entry_data in async_loaded_entries(hass).values():
+            tune_room = entry_data[DATA_TOPOLOGY].room(room_uuid)
+            if tune_room is not None:
+                return (entry_data[DATA_API],) + tune_room
+        return None
+
     async def set_active_control(service, skip_reload=True) -> None:
-        """List available rooms"""
+        """Set active control of one or more rooms.
+        Rooms are looked up in the topology of each account,
+        all rooms are updated concurrently.
+        """
         # Get parameters
-        room_uuid = service.data["room_uuid"]
+        room_uuids = service.data["room_uuid"]
         active = service.data.get("active", False)
 
-        ngenic = hass.data[DOMAIN][DATA_CLIENT]
-        for tune in await ngenic.async_tunes():
-            rooms = await tune.async_rooms()
-            for room in rooms:
-                if room.uuid() == room_uuid:
-                    room["activeControl"] = active
-                    _LOGGER.debug("Room: %s" % (room.json()))
-                    await room.async_update()
+        if any(find_room(room_uuid) is None for room_uuid in room_uuids):
+            # the room might have been added after the topology was discovered
+            await asyncio.gather(*[
+                entry_data[DATA_TOPOLOGY].async_refresh()
+                for entry_data in async_loaded_entries(hass).values()
+            ])
+
+        rooms = []
+        for room_uuid in room_uuids:
+            api_tune_room = find_room(room_uuid)
+            if api_tune_room is None:
+                _LOGGER.warning("Room %s was not found" % room_uuid)
+                continue
+            rooms.append(api_tune_room)
+
+        async def update_room(api, tune, room):
+            # rooms are written as a whole, write the current room rather than the room
+            # in the topology, so a target temperature set elsewhere is not reverted
+            current = await api.async_room(tune, room.uuid(), max_age=timedelta(0))
+            current["activeControl"] = active
+            _LOGGER.debug("Room: %s" % (current.json()))
+            await api.async_update_room(tune, current)
+
+            # the room models of the topology are what the thermostats follow
+            room["activeControl"] = active
+
+        results = await asyncio.gather(
+            *[update_room(api, tune, room) for api, tune, room in rooms],
+            return_exceptions=True
+        )
+
+        # the control rooms of the thermostats have changed,
+        # also for rooms that were updated before another room failed
+        for entry_data in async_loaded_entries(hass).values():
+            await entry_data[DATA_TOPOLOGY].async_save()
+            entry_data[DATA_TOPOLOGY].async_update_listeners()
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def import_statistics(service) -> None:
+        """Import measurement history into long-term statistics.
+        The import runs in the background as it can take a long time.
+        """
+        from_date = service.data["start"]
+        to_date = service.data.get("end", dt_util.now().date())
+        node_uuids = service.data.get("node_uuid")
+
+        # every account imports its own nodes
+        for entry_id, entry_data in async_loaded_entries(hass).items():
+            importer = NgenicStatisticsImporter(
+                hass,
+                entry_data[DATA_API],
+                entry_data[DATA_TOPOLOGY]
+            )
+            hass.async_create_background_task(
+                importer.async_import(from_date, to_date, node_uuids),
+                "ngenic statistics import %s" % entry_id
+            )
 
     if not hass.services.has_service(DOMAIN, SERVICE_SET_ACTIVE_CONTROL):
         # Register services
@@ -39,8 +111,22 @@ def async_register_services(hass):
             verify_domain_control(hass, DOMAIN)(set_active_control),
             schema=vol.Schema(
                 {
-                    vol.Required("room_uuid"): cv.string,
+                    vol.Required("room_uuid"): vol.All(cv.ensure_list, [cv.string]),
                     vol.Required("active"): cv.boolean
                 }
             ),
         )
+
+    if not hass.services.has_service(DOMAIN, SERVICE_IMPORT_STATISTICS):
+        hass.services.async_register(
+            DOMAIN,
+            SERVICE_IMPORT_STATISTICS,
+            verify_domain_control(hass, DOMAIN)(import_statistics),
+            schema=vol.Schema(
+                {
+                    vol.Required("start"): cv.date,
+                    vol.Optional("end"): cv.date,
+                    vol.Optional("node_uuid"): vol.All(cv.ensure_list, [cv.string])
+                }
+            ),
+        )
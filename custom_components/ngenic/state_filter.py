@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from .const import (
+    CONF_DEADBAND,
+    CONF_DEADBAND_PERCENT,
+    CONF_MIN_WRITE_INTERVAL,
+    CONF_HEARTBEAT,
+    DEFAULT_STATE_WRITES
+)
+
+def option_key(sensor_class, option):
+    """Get the name of a state write option of a sensor class, e.g. `power_deadband`"""
+    return "%s_%s" % (sensor_class, option)
+
+class NgenicStateFilter:
+    """Decide which new values of a sensor are written to Home Assistant.
+
+    Every written state ends up in the recorder, so small changes within
+    the deadband and changes too soon after the last write are held back.
+    A held back change is written once the heartbeat has passed.
+    """
+
+    def __init__(self, deadband=0.0, deadband_percent=0.0, min_write_interval=timedelta(0), heartbeat=timedelta(0)):
+        self._deadband = deadband
+        self._deadband_percent = deadband_percent
+        self._min_write_interval = min_write_interval
+        self._heartbeat = heartbeat
+        self._last_write = None
+
+    @classmethod
+    def from_options(cls, options, sensor_class):
+        """Create the filter of a sensor class from the options of a config entry"""
+        defaults = DEFAULT_STATE_WRITES[sensor_class]
+
+        def get(option):
+            return options.get(option_key(sensor_class, option), defaults[option])
+
+        return cls(
+            get(CONF_DEADBAND),
+            get(CONF_DEADBAND_PERCENT),
+            timedelta(seconds=get(CONF_MIN_WRITE_INTERVAL)),
+            timedelta(seconds=get(CONF_HEARTBEAT))
+        )
+
+    def should_write(self, written, value, now):
+        """Return True if `value` should replace the `written` value"""
+        if written is None or value is None or self._last_write is None:
+            return True
+
+        elapsed = now - self._last_write
+        if elapsed < self._min_write_interval:
+            return False
+
+        if self._heartbeat and elapsed >= self._heartbeat:
+            return True
+
+        change = abs(value - written)
+        return change >= self._deadband and change >= abs(written) * self._deadband_percent / 100
+
+    def written(self, now):
+        """Record that a value was written"""
+        self._last_write = now
@@ -0,0 +1,213 @@
+import logging
+from datetime import timedelta
+
+from ngenicpy.models.node import NodeType
+from ngenicpy.models.measurement import MeasurementType
+
+from homeassistant.components.recorder import get_instance
+from homeassistant.components.recorder.statistics import (
+    async_add_external_statistics,
+    statistics_during_period
+)
+from homeassistant.const import (
+    PERCENTAGE,
+    UnitOfTemperature,
+    UnitOfEnergy,
+    UnitOfPower
+)
+import homeassistant.util.dt as dt_util
+
+from .const import (
+    DOMAIN,
+    STATISTICS_CHUNK_DAYS,
+    STATISTICS_SAMPLE_PERIOD
+)
+from .errors import ApiUnavailable
+from .measurement import get_from_to_date
+
+_LOGGER = logging.getLogger(__name__)
+
+# measurement type -> (name, unit, factor to convert the API value to the unit)
+MEAN_TYPES = {
+    MeasurementType.TEMPERATURE: ("temperature", UnitOfTemperature.CELSIUS, 1),
+    MeasurementType.HUMIDITY: ("humidity", PERCENTAGE, 1),
+    MeasurementType.POWER_KW: ("power", UnitOfPower.WATT, 1000)
+}
+SUM_TYPES = {
+    MeasurementType.ENERGY_KWH: ("energy", UnitOfEnergy.KILO_WATT_HOUR, 1)
+}
+
+def get_statistic_id(node, measurement_type):
+    """Get the id of the external statistic of a node measurement"""
+    return "%s:%s_%s" % (DOMAIN, node.uuid().replace("-", "_"), measurement_type.value.lower())
+
+class NgenicStatisticsImporter:
+    """Import measurement history into Home Assistant long-term statistics.
+
+    The history is fetched one chunk of days at a time, each chunk is
+    written to the recorder before the next one is fetched.
+    Temperature, humidity and power are stored as hourly mean, min and max,
+    energy is stored as an hourly sum that continues from any statistics
+    already recorded before the imported range.
+
+    A measurement that fails to import is logged and skipped, the chunks
+    imported before the failure are kept. The import is stopped if the
+    API becomes unavailable.
+    """
+
+    def __init__(self, hass, api, topology):
+        self._hass = hass
+        self._api = api
+        self._topology = topology
+
+    async def async_import(self, from_date, to_date, node_uuids=None):
+        """Import all days from `from_date` (inclusive) to `to_date` (exclusive)"""
+        failed = 0
+        for tune in self._topology.tunes:
+            for node in tune.nodes:
+                if node_uuids and node.uuid() not in node_uuids:
+                    continue
+
+                name = self._node_name(node, tune.rooms)
+                for measurement_type in self._topology.measurement_types(node):
+                    if measurement_type not in MEAN_TYPES and measurement_type not in SUM_TYPES:
+                        continue
+                    try:
+                        if not await self._async_import_measurement(node, name, measurement_type, from_date, to_date):
+                            failed += 1
+                    except ApiUnavailable:
+                        # the API has already logged that it is unavailable
+                        _LOGGER.warning("Stopped importing statistics as the Ngenic API is unavailable")
+                        return
+
+        if failed:
+            _LOGGER.warning("Imported statistics from %s to %s, %d measurements failed" % (from_date, to_date, failed))
+        else:
+            _LOGGER.info("Imported statistics from %s to %s" % (from_date, to_date))
+
+    async def _async_import_measurement(self, node, name, measurement_type, from_date, to_date):
+        """Import a single measurement type of a node, chunk by chunk.
+        A failure is logged, and the chunks imported before it are kept.
+        Return True if all chunks were imported.
+        """
+        statistic_id = get_statistic_id(node, measurement_type)
+        has_sum = measurement_type in SUM_TYPES
+        type_name, unit, factor = SUM_TYPES[measurement_type] if has_sum else MEAN_TYPES[measurement_type]
+        metadata = {
+            "has_mean": not has_sum,
+            "has_sum": has_sum,
+            "name": "%s %s" % (name, type_name),
+            "source": DOMAIN,
+            "statistic_id": statistic_id,
+            "unit_of_measurement": unit
+        }
+
+        _LOGGER.info("Importing statistics for %s from %s to %s" % (statistic_id, from_date, to_date))
+        try:
+            await self._async_import_chunks(node, measurement_type, metadata, factor, from_date, to_date)
+        except ApiUnavailable:
+            raise
+        except Exception:
+            _LOGGER.exception("Failed to import statistics for %s" % statistic_id)
+            return False
+        return True
+
+    async def _async_import_chunks(self, node, measurement_type, metadata, factor, from_date, to_date):
+        """Fetch and write the statistics of a measurement type one chunk of days at a time"""
+        statistic_id = metadata["statistic_id"]
+        has_sum = metadata["has_sum"]
+        total = None
+        if has_sum:
+            total = await self._async_sum_before(statistic_id, dt_util.start_of_local_day(from_date))
+
+        chunk_start = from_date
+        while chunk_start < to_date:
+            chunk_end = min(chunk_start + timedelta(days=STATISTICS_CHUNK_DAYS), to_date)
+            from_dt, to_dt = get_from_to_date(chunk_start, chunk_end)
+            measurements = await self._api.async_measurement(
+                node,
+                measurement_type,
+                from_dt=from_dt,
+                to_dt=to_dt,
+                period="PT1H" if has_sum else STATISTICS_SAMPLE_PERIOD,
+                cache=False
+            )
+
+            if has_sum:
+                statistics, total = self._hourly_sums(measurements, factor, total)
+            else:
+                statistics = self._hourly_means(measurements, factor)
+
+            if statistics:
+                async_add_external_statistics(self._hass, metadata, statistics)
+            _LOGGER.debug("Imported %d hours of %s from %s to %s" % (len(statistics), statistic_id, chunk_start, chunk_end))
+
+            chunk_start = chunk_end
+
+    async def _async_sum_before(self, statistic_id, start):
+        """Get the sum of the statistic in the hour before `start`, or 0 if there is none"""
+        stats = await get_instance(self._hass).async_add_executor_job(
+            statistics_during_period,
+            self._hass,
+            start - timedelta(hours=1),
+            start,
+            {statistic_id},
+            "hour",
+            None,
+            {"sum"}
+        )
+        rows = stats.get(statistic_id)
+        if not rows or rows[-1].get("sum") is None:
+            return 0
+        return rows[-1]["sum"]
+
+    def _hourly_means(self, measurements, factor):
+        """Aggregate samples to hourly mean, min and max"""
+        hours = {}
+        for hour, value in self._hourly_values(measurements, factor):
+            hours.setdefault(hour, []).append(value)
+
+        return [
+            {
+                "start": hour,
+                "mean": sum(values) / len(values),
+                "min": min(values),
+                "max": max(values)
+            }
+            for hour, values in sorted(hours.items())
+        ]
+
+    def _hourly_sums(self, measurements, factor, total):
+        """Accumulate hourly consumption to a running sum.
+        Return a tuple with the statistics and the new total.
+        """
+        statistics = []
+        for hour, value in self._hourly_values(measurements, factor):
+            total += value
+            statistics.append({
+                "start": hour,
+                "state": value,
+                "sum": total
+            })
+        return statistics, total
+
+    def _hourly_values(self, measurements, factor):
+        """Yield the start of the hour and the converted value of each measurement"""
+        if not measurements:
+            # measurement API will return None if no measurements were found for the period
+            return
+        if not isinstance(measurements, list):
+            measurements = [measurements]
+
+        for measurement in measurements:
+            measured_at = dt_util.as_utc(dt_util.parse_datetime(measurement["time"]))
+            yield measured_at.replace(minute=0, second=0, microsecond=0), measurement["value"] * factor
+
+    def _node_name(self, node, rooms):
+        """Get a name for the statistics of a node, named in the same way as its sensors"""
+        node_name = "Ngenic %s" % node.get_type().name.lower()
+        if node.get_type() == NodeType.SENSOR:
+            for room in rooms:
+                if room["nodeUuid"] == node.uuid():
+                    return "%s %s" % (node_name, room["name"])
+        return node_name
@@ -0,0 +1,348 @@
+import logging
+
+from ngenicpy.models.tune import Tune
+from ngenicpy.models.room import Room
+from ngenicpy.models.node import Node
+from ngenicpy.models.measurement import MeasurementType
+
+from homeassistant.core import callback
+from homeassistant.helpers.storage import Store
+
+from .const import (
+    DOMAIN,
+    STORAGE_VERSION
+)
+from .util import async_gather_limited
+
+_LOGGER = logging.getLogger(__name__)
+
+async def async_discover_topology(api, limit):
+    """Discover all tunes, rooms, nodes and node measurement types.
+    Return the topology in the same json format as it is stored, except that the
+    rooms, nodes or measurement types the API didn't answer with a list are None.
+    """
+    tmp_tunes = await api.async_tunes() or []
+
+    # listing tunes contain less information than when querying a single tune
+    tunes = await async_gather_limited(
+        limit,
+        *[api.async_tune(tmp_tune.uuid()) for tmp_tune in tmp_tunes]
+    )
+    tune_data = await async_gather_limited(
+        limit,
+        *[api.async_rooms(tune) for tune in tunes],
+        *[api.async_nodes(tune) for tune in tunes]
+    )
+    tune_rooms, tune_nodes = tune_data[:len(tunes)], tune_data[len(tunes):]
+
+    nodes = [node for tune_node_list in tune_nodes for node in tune_node_list or []]
+    node_measurement_types = await async_gather_limited(
+        limit,
+        *[_async_measurement_types(api, node) for node in nodes]
+    )
+    measurement_types = {
+        node.uuid(): None if types is None else [measurement_type.value for measurement_type in types]
+        for node, types in zip(nodes, node_measurement_types)
+    }
+
+    return [
+        {
+            "tune": tune.json(),
+            "rooms": None if rooms is None else [room.json() for room in rooms],
+            "nodes": None if tune_node_list is None else [
+                dict(node.json(), measurementTypes=measurement_types[node.uuid()])
+                for node in tune_node_list
+            ]
+        }
+        for tune, rooms, tune_node_list in zip(tunes, tune_rooms, tune_nodes)
+    ]
+
+async def _async_measurement_types(api, node):
+    """List the measurement types of a node, or None if the API answered without any"""
+    try:
+        return await api.async_measurement_types(node)
+    except TypeError:
+        # ngenicpy fails to list the types of an empty answer
+        return None
+
+def _topology_fields(tunes_json):
+    """Get the fields of the topology json that decide which entities exist and what they are named"""
+    return {
+        tune_json["tune"]["uuid"]: (
+            tune_json["tune"].get("name"),
+            tune_json["tune"].get("roomToControlUuid"),
+            {
+                room_json["uuid"]: (room_json.get("name"), room_json.get("nodeUuid"), room_json.get("activeControl"))
+                for room_json in tune_json["rooms"]
+            },
+            {
+                node_json["uuid"]: (node_json.get("type"), node_json.get("measurementTypes"))
+                for node_json in tune_json["nodes"]
+            }
+        )
+        for tune_json in tunes_json
+    }
+
+class NgenicTuneTopology:
+    """A tune together with its rooms and nodes"""
+
+    def __init__(self, tune, rooms, nodes):
+        self.tune = tune
+        self.rooms = rooms
+        self.nodes = nodes
+
+    def room(self, room_uuid):
+        """Get a room by its uuid, or None if the tune has no such room"""
+        for room in self.rooms:
+            if room.uuid() == room_uuid:
+                return room
+        return None
+
+    def node(self, node_uuid):
+        """Get a node by its uuid, or None if the tune has no such node"""
+        for node in self.nodes:
+            if node.uuid() == node_uuid:
+                return node
+        return None
+
+class NgenicTopology:
+    """The tunes, rooms and nodes of an Ngenic account.
+
+    The topology is persisted with the Home Assistant storage helper so
+    that entities can be created at startup without any discovery calls
+    to the API. A refresh will discover the topology again and apply
+    the differences to the already loaded models, then tell the platforms
+    so they can add, retire and rename their entities.
+
+    An empty answer for the rooms, nodes or measurement types of a tune or
+    node is taken as unknown rather than as none, and the loaded ones are kept.
+    The platforms are told after every refresh, and count in `refreshes` how
+    long an entity has been missing before it is retired.
+    """
+
+    def __init__(self, hass, api, entry_id, limit, discovered=None):
+        self._hass = hass
+        self._api = api
+        self._limit = limit
+
+        # topology json discovered by the config flow, used instead of the first discovery
+        self._discovered = discovered
+        self._store = Store(hass, STORAGE_VERSION, "%s.%s.topology" % (DOMAIN, entry_id))
+        self._tunes = []
+
+        # room uuid -> (tune, room), built on first use and dropped when the topology changes
+        self._room_index = None
+        self._listeners = []
+
+        # number of refreshes that have discovered the topology
+        self.refreshes = 0
+
+    @property
+    def tunes(self):
+        """Return the list of `NgenicTuneTopology`"""
+        return self._tunes
+
+    def room(self, room_uuid):
+        """Get a room and its tune by the room uuid.
+        Return a (tune, room) tuple, or None if there is no such room.
+        """
+        if self._room_index is None:
+            self._room_index = {
+                room.uuid(): (tune.tune, room)
+                for tune in self._tunes
+                for room in tune.rooms
+            }
+        return self._room_index.get(room_uuid)
+
+    def async_add_listener(self, listener):
+        """Listen for changes of the topology.
+        The listener is called without arguments after every refresh, and when the loaded models have changed.
+        Return a function that removes the listener.
+        """
+        self._listeners.append(listener)
+
+        @callback
+        def remove_listener():
+            self._listeners.remove(listener)
+
+        return remove_listener
+
+    @callback
+    def async_update_listeners(self):
+        """Tell the listeners that the loaded models have changed"""
+        for listener in list(self._listeners):
+            listener()
+
+    def measurement_types(self, node):
+        """Get the measurement types of a node without asking the API"""
+        return list(node._measurementTypes or [])
+
+    async def async_load(self):
+        """Load the topology from storage.
+        The topology is discovered from the API if nothing has been stored yet.
+        Return True if the topology was loaded from storage.
+        """
+        stored = await self._store.async_load()
+        if stored is not None:
+            self._tunes = [self._tune_from_json(tune_json) for tune_json in stored["tunes"]]
+            self._room_index = None
+            _LOGGER.debug("Loaded topology with %d tunes from storage" % len(self._tunes))
+            return True
+
+        tunes_json = await self._async_discover()
+        self._tunes = [self._tune_from_json(tune_json) for tune_json in tunes_json]
+        self._room_index = None
+        await self._store.async_save({"tunes": tunes_json})
+        return False
+
+    async def async_refresh(self):
+        """Discover the topology from the API and apply any changes.
+        Return True if the topology changed.
+        """
+        tunes_json = await self._async_discover()
+        if not tunes_json and self._tunes:
+            # retiring every entity is more likely to be caused by the API than by the account
+            _LOGGER.warning("No tunes were discovered, keeping the loaded topology")
+            return False
+
+        self.refreshes += 1
+        if _topology_fields(tunes_json) == _topology_fields(self._to_json()):
+            # e.g. target temperatures change all the time, but don't change any entity,
+            # the platforms still count how long their missing entities have been missing
+            _LOGGER.debug("Topology is unchanged")
+            self.async_update_listeners()
+            return False
+
+        current = {tune.tune.uuid(): tune for tune in self._tunes}
+        tunes = []
+        for tune_json in tunes_json:
+            tune_uuid = tune_json["tune"]["uuid"]
+            if tune_uuid in current:
+                tunes.append(self._apply_changes(current[tune_uuid], tune_json))
+            else:
+                _LOGGER.info("Discovered new tune %s" % tune_uuid)
+                tunes.append(self._tune_from_json(tune_json))
+
+        for tune_uuid in current.keys() - set(tune.tune.uuid() for tune in tunes):
+            _LOGGER.info("Tune %s has been removed" % tune_uuid)
+
+        self._tunes = tunes
+        self._room_index = None
+        await self._store.async_save({"tunes": tunes_json})
+        self.async_update_listeners()
+        return True
+
+    async def async_save(self):
+        """Save the loaded models, e.g. after rooms have been updated through the API"""
+        await self._store.async_save({"tunes": self._to_json()})
+
+    async def _async_discover(self):
+        """Discover the topology, or use the topology discovered by the config flow"""
+        if self._discovered is not None:
+            tunes_json, self._discovered = self._discovered, None
+            _LOGGER.debug("Using topology discovered by the config flow")
+        else:
+            tunes_json = await async_discover_topology(self._api, self._limit)
+        return self._fill_unknown(tunes_json)
+
+    def _fill_unknown(self, tunes_json):
+        """Use the loaded rooms, nodes and measurement types where the API didn't answer with a list,
+        or none if they have never been loaded
+        """
+        loaded = {tune_json["tune"]["uuid"]: tune_json for tune_json in self._to_json()}
+        for tune_json in tunes_json:
+            tune_uuid = tune_json["tune"]["uuid"]
+            loaded_tune = loaded.get(tune_uuid, {"rooms": [], "nodes": []})
+            for key in ("rooms", "nodes"):
+                if tune_json[key] is None:
+                    _LOGGER.warning("No %s were discovered for tune %s, keeping the loaded %s" % (key, tune_uuid, key))
+                    tune_json[key] = loaded_tune[key]
+
+            loaded_nodes = {node_json["uuid"]: node_json for node_json in loaded_tune["nodes"]}
+            for node_json in tune_json["nodes"]:
+                if node_json["measurementTypes"] is None:
+                    _LOGGER.warning("No measurement types were discovered for node %s, keeping the loaded types" % node_json["uuid"])
+                    node_json["measurementTypes"] = loaded_nodes.get(node_json["uuid"], {}).get("measurementTypes", [])
+        return tunes_json
+
+    def _to_json(self):
+        """Return the loaded topology in the stored json format"""
+        return [
+            {
+                "tune": tune.tune.json(),
+                "rooms": [room.json() for room in tune.rooms],
+                "nodes": [
+                    dict(node.json(), measurementTypes=self._node_measurement_types_json(node))
+                    for node in tune.nodes
+                ]
+            }
+            for tune in self._tunes
+        ]
+
+    def _tune_from_json(self, tune_json):
+        """Create tune, room and node models from stored json"""
+        # the models will share the session of the client
+        session = self._api.client._session
+        tune = Tune(session=session, json=tune_json["tune"])
+
+        return NgenicTuneTopology(
+            tune,
+            [Room(session=session, json=room_json, tune=tune) for room_json in tune_json["rooms"]],
+            [self._node_from_json(tune, node_json) for node_json in tune_json["nodes"]]
+        )
+
+    def _node_from_json(self, tune, node_json):
+        """Create a node model from stored json, including its measurement types"""
+        node_json = dict(node_json)
+        measurement_types = node_json.pop("measurementTypes", [])
+        node = Node(session=self._api.client._session, json=node_json, tune=tune)
+
+        # prime the measurement type cache of the node so it won't ask the API
+        node._measurementTypes = [MeasurementType(value) for value in measurement_types]
+        return node
+
+    def _node_measurement_types_json(self, node):
+        return [measurement_type.value for measurement_type in self.measurement_types(node)]
+
+    def _apply_changes(self, tune, tune_json):
+        """Update an already loaded tune with discovered json.
+        Models that still exist are updated in place, so references to them stay valid.
+        """
+        self._update_model(tune.tune, tune_json["tune"])
+
+        rooms = {room.uuid(): room for room in tune.rooms}
+        tune.rooms = [
+            self._update_model(rooms[room_json["uuid"]], room_json)
+            if room_json["uuid"] in rooms
+            else Room(session=self._api.client._session, json=room_json, tune=tune.tune)
+            for room_json in tune_json["rooms"]
+        ]
+
+        nodes = {node.uuid(): node for node in tune.nodes}
+        updated_nodes = []
+        for node_json in tune_json["nodes"]:
+            if node_json["uuid"] in nodes:
+                node = nodes[node_json["uuid"]]
+                updated = self._node_from_json(tune.tune, node_json)
+                self._update_model(node, updated.json())
+                node._measurementTypes = updated._measurementTypes
+            else:
+                _LOGGER.info("Discovered new node %s" % node_json["uuid"])
+                node = self._node_from_json(tune.tune, node_json)
+            updated_nodes.append(node)
+
+        for node_uuid in nodes.keys() - set(node.uuid() for node in updated_nodes):
+            _LOGGER.info("Node %s has been removed" % node_uuid)
+        tune.nodes = updated_nodes
+
+        return tune
+
+    def _update_model(self, model, model_json):
+        """Replace the json of a model with newly discovered json"""
+        if model.json() != model_json:
+            _LOGGER.debug("Updating %s %s" % (model.__class__.__name__.lower(), model.uuid()))
+            for attribute in list(model.json().keys() - model_json.keys()):
+                del model.json()[attribute]
+            for attribute, value in model_json.items():
+                model[attribute] = value
+        return model
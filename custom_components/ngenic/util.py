@@ -0,0 +1,26 @@
+import asyncio
+
+from homeassistant.core import callback
+
+from .const import DOMAIN
+
+async def async_gather_limited(limit, *aws):
+    """Run awaitables concurrently, but never more than `limit` at a time.
+    Results are returned in the same order as the awaitables were given.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[_run(aw) for aw in aws])
+
+@callback
+def async_loaded_entries(hass):
+    """Return the data of all loaded config entries, keyed by entry id"""
+    return {
+        entry.entry_id: hass.data[DOMAIN][entry.entry_id]
+        for entry in hass.config_entries.async_entries(DOMAIN)
+        if entry.entry_id in hass.data.get(DOMAIN, {})
+    }
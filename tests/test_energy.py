@@ -0,0 +1,252 @@
+"""Tests for the periods and days of the energy ledger"""
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from ngenicpy.models.measurement import MeasurementType
+
+import homeassistant.util.dt as dt_util
+
+from custom_components.ngenic.energy import (
+    NgenicEnergyLedger,
+    PERIOD_TODAY,
+    PERIOD_WEEK,
+    PERIOD_MONTH,
+    PERIOD_LAST_MONTH,
+    PERIOD_YEAR,
+    PERIOD_ROLLING_30_DAYS,
+    PERIODS,
+    get_period_dates
+)
+from custom_components.ngenic.measurement import (
+    get_from_to_date,
+    get_measurement_date
+)
+
+@pytest.fixture(autouse=True)
+def stockholm():
+    """Use a time zone with daylight saving time"""
+    previous = dt_util.DEFAULT_TIME_ZONE
+    dt_util.set_default_time_zone(ZoneInfo("Europe/Stockholm"))
+    yield
+    dt_util.set_default_time_zone(previous)
+
+def hours_between(from_date, to_date):
+    """Get the number of hours between local midnight of two dates"""
+    # subtracting aware datetimes in the same time zone ignores changes of the UTC offset
+    start = dt_util.as_utc(dt_util.start_of_local_day(from_date))
+    end = dt_util.as_utc(dt_util.start_of_local_day(to_date))
+    return (end - start).total_seconds() / 3600
+
+@pytest.mark.parametrize(
+    "today,expected_hours",
+    [
+        (date(2024, 3, 30), 24),
+        # clocks are set forward from 02:00 to 03:00
+        (date(2024, 3, 31), 23),
+        (date(2024, 10, 26), 24),
+        # clocks are set back from 03:00 to 02:00
+        (date(2024, 10, 27), 25)
+    ]
+)
+def test_today_spans_a_change_of_daylight_saving_time(today, expected_hours):
+    assert get_period_dates(PERIOD_TODAY, today) == (today, today + timedelta(days=1))
+    assert hours_between(*get_period_dates(PERIOD_TODAY, today)) == expected_hours
+
+def test_spring_change_of_daylight_saving_time():
+    # Tuesday after the clocks were set forward on Sunday
+    today = date(2024, 4, 2)
+    assert get_period_dates(PERIOD_WEEK, today) == (date(2024, 4, 1), date(2024, 4, 3))
+    assert get_period_dates(PERIOD_LAST_MONTH, today) == (date(2024, 3, 1), date(2024, 4, 1))
+    assert hours_between(*get_period_dates(PERIOD_LAST_MONTH, today)) == 31 * 24 - 1
+
+    from_date, to_date = get_period_dates(PERIOD_ROLLING_30_DAYS, today)
+    assert (from_date, to_date) == (date(2024, 3, 4), date(2024, 4, 3))
+    assert hours_between(from_date, to_date) == 30 * 24 - 1
+
+def test_autumn_change_of_daylight_saving_time():
+    # Sunday the clocks are set back
+    today = date(2024, 10, 27)
+    assert get_period_dates(PERIOD_WEEK, today) == (date(2024, 10, 21), date(2024, 10, 28))
+    assert hours_between(*get_period_dates(PERIOD_WEEK, today)) == 7 * 24 + 1
+
+    from_date, to_date = get_period_dates(PERIOD_MONTH, today)
+    assert (from_date, to_date) == (date(2024, 10, 1), date(2024, 10, 28))
+    assert hours_between(from_date, to_date) == 27 * 24 + 1
+
+@pytest.mark.parametrize(
+    "period,today,expected",
+    [
+        # first and last day of a month
+        (PERIOD_MONTH, date(2024, 5, 1), (date(2024, 5, 1), date(2024, 5, 2))),
+        (PERIOD_MONTH, date(2024, 4, 30), (date(2024, 4, 1), date(2024, 5, 1))),
+        (PERIOD_LAST_MONTH, date(2024, 5, 1), (date(2024, 4, 1), date(2024, 5, 1))),
+        (PERIOD_LAST_MONTH, date(2024, 5, 31), (date(2024, 4, 1), date(2024, 5, 1))),
+        # a week that starts in the previous month
+        (PERIOD_WEEK, date(2024, 5, 1), (date(2024, 4, 29), date(2024, 5, 2))),
+        # first and last day of a year
+        (PERIOD_YEAR, date(2024, 1, 1), (date(2024, 1, 1), date(2024, 1, 2))),
+        (PERIOD_YEAR, date(2024, 12, 31), (date(2024, 1, 1), date(2025, 1, 1))),
+        (PERIOD_LAST_MONTH, date(2025, 1, 1), (date(2024, 12, 1), date(2025, 1, 1))),
+        (PERIOD_LAST_MONTH, date(2025, 1, 31), (date(2024, 12, 1), date(2025, 1, 1))),
+        (PERIOD_WEEK, date(2025, 1, 1), (date(2024, 12, 30), date(2025, 1, 2))),
+        (PERIOD_ROLLING_30_DAYS, date(2025, 1, 10), (date(2024, 12, 12), date(2025, 1, 11)))
+    ]
+)
+def test_month_and_year_boundaries(period, today, expected):
+    assert get_period_dates(period, today) == expected
+
+@pytest.mark.parametrize(
+    "period,today,expected",
+    [
+        (PERIOD_TODAY, date(2024, 2, 29), (date(2024, 2, 29), date(2024, 3, 1))),
+        (PERIOD_MONTH, date(2024, 2, 29), (date(2024, 2, 1), date(2024, 3, 1))),
+        (PERIOD_LAST_MONTH, date(2024, 3, 1), (date(2024, 2, 1), date(2024, 3, 1))),
+        (PERIOD_LAST_MONTH, date(2023, 3, 1), (date(2023, 2, 1), date(2023, 3, 1))),
+        (PERIOD_ROLLING_30_DAYS, date(2024, 3, 1), (date(2024, 2, 1), date(2024, 3, 2))),
+        (PERIOD_ROLLING_30_DAYS, date(2023, 3, 1), (date(2023, 1, 31), date(2023, 3, 2))),
+        (PERIOD_YEAR, date(2024, 12, 31), (date(2024, 1, 1), date(2025, 1, 1)))
+    ]
+)
+def test_leap_years(period, today, expected):
+    assert get_period_dates(period, today) == expected
+
+def test_leap_year_has_366_days():
+    from_date, to_date = get_period_dates(PERIOD_YEAR, date(2024, 12, 31))
+    assert (to_date - from_date).days == 366
+    from_date, to_date = get_period_dates(PERIOD_YEAR, date(2023, 12, 31))
+    assert (to_date - from_date).days == 365
+
+@pytest.mark.parametrize("period", PERIODS)
+def test_periods_end_with_today_or_before(period):
+    today = date(2024, 10, 27)
+    from_date, to_date = get_period_dates(period, today)
+    assert from_date <= today < to_date or to_date <= today
+    assert to_date <= today + timedelta(days=1)
+
+def test_unknown_period():
+    with pytest.raises(ValueError):
+        get_period_dates("fortnight", date(2024, 1, 1))
+
+@pytest.mark.parametrize(
+    "from_date,to_date,expected",
+    [
+        (date(2024, 3, 31), date(2024, 4, 1), ("2024-03-31T00:00:00 Europe/Stockholm", "2024-04-01T00:00:00 Europe/Stockholm")),
+        (date(2024, 10, 27), date(2024, 10, 28), ("2024-10-27T00:00:00 Europe/Stockholm", "2024-10-28T00:00:00 Europe/Stockholm"))
+    ]
+)
+def test_from_to_date_is_local_midnight(from_date, to_date, expected):
+    assert get_from_to_date(from_date, to_date) == expected
+
+def test_from_to_date_in_utc():
+    dt_util.set_default_time_zone(dt_util.UTC)
+    assert get_from_to_date(date(2024, 10, 27), date(2024, 10, 28)) == ("2024-10-27T00:00:00 Z", "2024-10-28T00:00:00 Z")
+
+@pytest.mark.parametrize(
+    "time,expected",
+    [
+        # local midnight of the day the clocks are set forward, and the same time in UTC
+        ("2024-03-31T00:00:00+01:00", date(2024, 3, 31)),
+        ("2024-03-30T23:00:00Z", date(2024, 3, 31)),
+        ("2024-04-01T00:00:00+02:00", date(2024, 4, 1)),
+        # local midnight of the day the clocks are set back, and the same time in UTC
+        ("2024-10-27T00:00:00+02:00", date(2024, 10, 27)),
+        ("2024-10-26T22:00:00Z", date(2024, 10, 27)),
+        ("2024-10-28T00:00:00+01:00", date(2024, 10, 28))
+    ]
+)
+def test_measurement_date_is_local_date(time, expected):
+    assert get_measurement_date({"time": time, "value": 1.0}) == expected
+
+class FakeNode:
+    def uuid(self):
+        return "node"
+
+class FakeApi:
+    """Answers daily energy queries with a measurement at local midnight of every day"""
+
+    def __init__(self, energy):
+        # date -> kWh
+        self.energy = energy
+        self.queries = []
+
+    async def async_measurement(self, node, measurement_type, from_dt=None, to_dt=None, period=None):
+        assert measurement_type == MeasurementType.ENERGY_KWH and period == "P1D"
+        self.queries.append((from_dt, to_dt))
+        return [
+            {"time": dt_util.start_of_local_day(day).isoformat(), "value": value}
+            for day, value in self.energy.items()
+        ]
+
+class FakeStore:
+    def async_delay_save(self, data_func, delay):
+        self.saved = data_func()
+
+@pytest.fixture
+def frozen_now(monkeypatch):
+    """Set the current time, given in UTC"""
+    def freeze(utc):
+        monkeypatch.setattr(dt_util, "utcnow", lambda: utc)
+        monkeypatch.setattr(dt_util, "now", lambda time_zone=None: dt_util.as_local(utc))
+    return freeze
+
+def create_ledger(api):
+    ledger = NgenicEnergyLedger(None, api, "entry")
+    ledger._store = FakeStore()
+    return ledger
+
+@pytest.mark.parametrize(
+    "day,settled_at",
+    [
+        # 23 hours, settles at 02:00 local time on the next day, which is still +02:00
+        (date(2024, 3, 31), datetime(2024, 4, 1, 0, 0, tzinfo=timezone.utc)),
+        # 25 hours, settles at 02:00 local time on the next day, which is +01:00
+        (date(2024, 10, 27), datetime(2024, 10, 28, 1, 0, tzinfo=timezone.utc)),
+        # 24 hours, settles at the first 02:00 local time of the day the clocks are set back
+        (date(2024, 10, 26), datetime(2024, 10, 27, 0, 0, tzinfo=timezone.utc))
+    ]
+)
+def test_day_is_frozen_once_settled(frozen_now, day, settled_at):
+    ledger = create_ledger(None)
+    node = FakeNode()
+    ledger._days["node"] = {}
+    ledger._open_days["node"] = {}
+
+    before = settled_at - timedelta(minutes=1)
+    frozen_now(before)
+    ledger._store_days(node, {day: 12.5}, before)
+    assert ledger._days["node"] == {}
+    assert ledger._open_days["node"] == {day: (12.5, before)}
+
+    frozen_now(settled_at)
+    ledger._store_days(node, {day: 13.0}, settled_at)
+    assert ledger._days["node"] == {day.isoformat(): 13.0}
+    assert ledger._open_days["node"] == {}
+    assert ledger._store.saved["days"] == {"node": {day.isoformat(): 13.0}}
+
+def test_ledger_freezes_the_day_the_clocks_are_set_back(frozen_now):
+    day = date(2024, 10, 27)
+    api = FakeApi({day: 12.5})
+    ledger = create_ledger(api)
+    node = FakeNode()
+
+    # 01:59 local time, the 25 hour day has not settled yet
+    frozen_now(datetime(2024, 10, 28, 0, 59, tzinfo=timezone.utc))
+    days = asyncio.run(ledger._async_days(node, day, day + timedelta(days=1), timedelta(minutes=10)))
+    assert days == {day: 12.5}
+    assert api.queries == [("2024-01-01T00:00:00 Europe/Stockholm", "2024-10-28T00:00:00 Europe/Stockholm")]
+    assert day.isoformat() not in ledger._days["node"]
+
+    # the open day is fetched again once it has settled and is older than `max_age`, then it is frozen
+    frozen_now(datetime(2024, 10, 28, 1, 10, tzinfo=timezone.utc))
+    days = asyncio.run(ledger._async_days(node, day, day + timedelta(days=1), timedelta(minutes=10)))
+    assert days == {day: 12.5}
+    assert api.queries[1] == ("2024-10-27T00:00:00 Europe/Stockholm", "2024-10-28T00:00:00 Europe/Stockholm")
+    assert ledger._days["node"] == {day.isoformat(): 12.5}
+
+    # a frozen day is never fetched again
+    frozen_now(datetime(2024, 10, 28, 12, 0, tzinfo=timezone.utc))
+    asyncio.run(ledger._async_days(node, day, day + timedelta(days=1), timedelta(minutes=10)))
+    assert len(api.queries) == 2